@@ -1,13 +1,15 @@
-from flask import Flask,render_template,request,redirect, session, url_for, flash # type: ignore
+from flask import Flask,render_template,request,redirect, session, url_for, flash, jsonify, g, has_app_context, send_file, make_response # type: ignore
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user, UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash # type: ignore
 import calendar
-from calendar import monthrange
+from functools import lru_cache
 import jpholiday # type: ignore
 import sqlite3
 import os
 import gspread # type: ignore
 from oauth2client.service_account import ServiceAccountCredentials # type: ignore
+from gspread.utils import rowcol_to_a1 # type: ignore
+from gspread.exceptions import SpreadsheetNotFound, WorksheetNotFound # type: ignore
 import time
 import json
 import hashlib
@@ -16,17 +18,54 @@ from datetime import datetime, date, timedelta
 import pytz
 import logging
 import re
+import shutil
+import socket
 from werkzeug.exceptions import abort
+from scoring import (
+    place_score, rescore, apply_leaderboard_delta, rebuild_leaderboard,
+    setup_period_rules, seed_period_rules
+)
+import images
+import assets
+from fragment_cache import FragmentCacheExtension, clear_fragments
+try:
+    import fcntl
+except ImportError:  # Windows のローカル開発ではロックなしで動かす
+    fcntl = None
 
 logging.basicConfig(level=logging.INFO)
 
 app = Flask(__name__)
+# テンプレートの {% cache %} … {% endcache %}（fragment_cache.py）
+app.jinja_env.add_extension(FragmentCacheExtension)
 
 SHEET_NAME = "miyakeiba_backup"
-TABLES = ['race_entries', 'race_result', 'race_schedule', 'raise_horse', 'sqlite_sequence', 'users']
+SHEET_CLIENT_TTL = 45 * 60  # アクセストークンの期限(60分)より前に認証し直す
+TABLES = ['horseentrybefore', 'race_entries', 'race_result', 'race_schedule', 'raise_horse', 'scoring_period_rules', 'sqlite_sequence', 'users']
 BACKUP_INTERVAL = 60
+BACKUP_FORCE_DELAY = 5      # 強制バックアップでも、この秒数は後続の要求を待ってまとめる
+BACKUP_IDLE_POLL = 60       # 要求がない時にキューを見直す間隔
+BACKUP_LEASE_SECONDS = 600  # この秒数を過ぎた担当は、落ちたワーカーのものとみなして引き継ぐ
+BACKUP_RETRY_MAX = 1800     # 同期に失敗し続けた時の再試行間隔の上限（BACKUP_INTERVAL から倍々に延ばす）
+RACE_VIDEO_REFRESH_INTERVAL = 600  # race_video シートを取り込み直す間隔
 DB_NAME = "miyakeiba_app.db"
+# WAL にして、バックアップの長い読み込み中でも投票の書き込みが待たされないようにする
+DB_PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA cache_size = -8000",      # 約8MB
+    "PRAGMA mmap_size = 67108864",    # 64MB
+    "PRAGMA temp_store = MEMORY",
+]
 SKIP_STARTUP_BACKUP = os.getenv("SKIP_STARTUP_BACKUP", "false").lower() == "true"
+# 起動モード: auto（スナップショット→スプレッドシート）/ snapshot / sheets
+BOOT_MODE = os.getenv("BOOT_MODE", "auto").lower()
+SNAPSHOT_PATH = DB_NAME + ".snapshot"
+SNAPSHOT_MAX_AGE = int(os.getenv("SNAPSHOT_MAX_AGE", "0"))  # 秒。0なら期限なし
+BOOT_LOCK_PATH = DB_NAME + ".lock"
+BOOT_MARKER_PATH = DB_NAME + ".boot"
+DEPLOY_ID = os.getenv("RENDER_GIT_COMMIT") or os.getenv("DEPLOY_ID", "local")
 app.secret_key = 'your_secret_key'
 app.config.update(
     SESSION_COOKIE_SECURE=True,   # HTTPS を使う場合
@@ -49,35 +88,163 @@ class User(UserMixin):
     def get_id(self):
         return str(self.id)
 
+# ログイン中のユーザーはリクエストごとに読み込まれるので、id・名前・権限だけをプロセス内に持つ。
+# 別プロセス（他のワーカーや DB の直接編集）での変更は USER_CACHE_TTL 秒で反映される
+USER_CACHE_SIZE = 512
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "300"))  # 秒。0ならキャッシュしない
+user_cache = {}
+user_cache_lock = threading.Lock()
+
+def cache_user(user):
+    with user_cache_lock:
+        user_cache.pop(user.id, None)
+        if len(user_cache) >= USER_CACHE_SIZE:
+            user_cache.pop(next(iter(user_cache)))
+        user_cache[user.id] = (time.monotonic(), user.username, user.role)
+
+def invalidate_user_cache(user_id=None):
+    # user_id を省略するとすべて捨てる（バックアップからの復元など）
+    with user_cache_lock:
+        if user_id is None:
+            user_cache.clear()
+        else:
+            user_cache.pop(int(user_id), None)
+
 @login_manager.user_loader
 def load_user(user_id):
+    user_id = int(user_id)
+    with user_cache_lock:
+        cached = user_cache.pop(user_id, None)
+        if cached and time.monotonic() - cached[0] < USER_CACHE_TTL:
+            # 使われた順に並べ直して、古いものから追い出す
+            user_cache[user_id] = cached
+            return User(user_id, cached[1], cached[2])
+
     conn = connect_db()
     cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE id = ?", (int(user_id),))
+    cursor.execute("SELECT id, username, role FROM users WHERE id = ?", (user_id,))
     row = cursor.fetchone()
     conn.close()
     if row:
-        return User(row['id'], row['username'], row['role'])
+        user = User(row['id'], row['username'], row['role'])
+        if USER_CACHE_TTL > 0:
+            cache_user(user)
+        return user
     return None
     
 
-def get_sheet_client():
+def open_spreadsheet():
     creds_dict = json.loads(os.environ["GOOGLE_CREDENTIALS"])
     scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
     creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
     client = gspread.authorize(creds)
     return client.open(SHEET_NAME)
 
+# 認証済みクライアントとシートのハンドルはプロセス内で使い回す
+sheet_client_lock = threading.Lock()
+sheet_client_cache = {"spreadsheet": None, "created_at": 0.0, "worksheets": {}}
+
+def get_sheet_client():
+    """
+    認証済みのスプレッドシートを返します。
+    アクセストークン（有効期限60分）が切れる前に SHEET_CLIENT_TTL で作り直すので、
+    リクエストの途中で期限切れになることはありません。
+    """
+    with sheet_client_lock:
+        if (sheet_client_cache["spreadsheet"] is None
+                or time.time() - sheet_client_cache["created_at"] >= SHEET_CLIENT_TTL):
+            sheet_client_cache["spreadsheet"] = open_spreadsheet()
+            sheet_client_cache["created_at"] = time.time()
+            sheet_client_cache["worksheets"] = {}
+        return sheet_client_cache["spreadsheet"]
+
+def get_worksheet(name, create=False):
+    sheet = get_sheet_client()
+    with sheet_client_lock:
+        worksheet = sheet_client_cache["worksheets"].get(name)
+        if worksheet is None:
+            try:
+                worksheet = sheet.worksheet(name)
+            except WorksheetNotFound:
+                # 後から追加したテーブルは、初回のバックアップでシートを作る
+                if not create:
+                    raise
+                worksheet = sheet.add_worksheet(title=name, rows=100, cols=10)
+            sheet_client_cache["worksheets"][name] = worksheet
+        return worksheet
+
+def reset_sheet_client():
+    # 認証エラーなどの後は、次の呼び出しで作り直させる
+    with sheet_client_lock:
+        sheet_client_cache["spreadsheet"] = None
+        sheet_client_cache["worksheets"] = {}
+
+# sqlite_sequence にはトリガーを張れないため、差分追跡の対象から外して毎回丸ごと送る
+TRACKED_TABLES = [table for table in TABLES if table != 'sqlite_sequence']
+# 差分を書き込む時に1回の batch_update にまとめる最大範囲数
+BACKUP_BATCH_SIZE = 500
+
+def setup_change_tracking(conn):
+    """
+    各テーブルにトリガーを張り、変更された行を backup_changes に記録します。
+    backup_sheet_rows には「どの行がスプレッドシートの何行目にあるか」を保持します。
+    """
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS backup_changes (
+            seq INTEGER PRIMARY KEY,
+            table_name TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            op TEXT NOT NULL
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS backup_sheet_rows (
+            table_name TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            sheet_row INTEGER NOT NULL,
+            PRIMARY KEY (table_name, row_id)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS backup_sheet_columns (
+            table_name TEXT PRIMARY KEY,
+            columns TEXT NOT NULL
+        )
+    """)
+    for table in TRACKED_TABLES:
+        for event, op, ref in (('INSERT', 'upsert', 'NEW'), ('UPDATE', 'upsert', 'NEW'), ('DELETE', 'delete', 'OLD')):
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_backup
+                AFTER {event} ON {table}
+                BEGIN
+                    INSERT INTO backup_changes (table_name, row_id, op) VALUES ('{table}', {ref}.rowid, '{op}');
+                END
+            """)
+    conn.commit()
+
+def get_rowid_column(cursor, table):
+    # INTEGER PRIMARY KEY の列は rowid の別名なので、シートの値から rowid を復元できる
+    cursor.execute(f"PRAGMA table_info({table})")
+    for column in cursor.fetchall():
+        if column[5] == 1 and column[2].upper() == 'INTEGER':
+            return column[1]
+    return None
+
 def load_backup_from_sheet():
     print("📥 スプレッドシートからバックアップを読み込み中...")
-    sheet = get_sheet_client()
     conn = sqlite3.connect(DB_NAME)
     cursor = conn.cursor()
+    setup_entry_tables(conn)
+    setup_period_rules(conn)
+    setup_change_tracking(conn)
+    setup_backup_queue(conn)
 
+    failed_tables = []
     for table in TABLES:
         try:
             print(f"📄 テーブル `{table}` を読み込み中...")
-            worksheet = sheet.worksheet(table)
+            worksheet = get_worksheet(table)
             data = worksheet.get_all_values()
 
             if not data or len(data) < 2:
@@ -87,6 +254,16 @@ def load_backup_from_sheet():
             columns = data[0]
             rows = data[1:]
 
+            # 見出しがテーブルの列名と違う（手で作ったシートなど）時は、列の並び順で対応させる
+            cursor.execute(f"PRAGMA table_info({table})")
+            table_columns = [column[1] for column in cursor.fetchall()]
+            if not set(columns) <= set(table_columns):
+                if len(columns) != len(table_columns):
+                    print(f"❌ `{table}` の見出しが一致しません。")
+                    failed_tables.append(table)
+                    continue
+                columns = table_columns
+
             placeholders = ', '.join(['?'] * len(columns))
             columns_joined = ', '.join(columns)
 
@@ -94,103 +271,714 @@ def load_backup_from_sheet():
             cursor.executemany(
                 f"INSERT INTO {table} ({columns_joined}) VALUES ({placeholders})", rows
             )
+
+            # 読み込んだ行とシート上の行番号を対応付けておく（次回以降は差分だけ送る）
+            if table in TRACKED_TABLES:
+                cursor.execute("DELETE FROM backup_sheet_rows WHERE table_name = ?", (table,))
+                rowid_column = get_rowid_column(cursor, table)
+                if rowid_column in columns:
+                    index = columns.index(rowid_column)
+                    cursor.executemany(
+                        "INSERT OR REPLACE INTO backup_sheet_rows (table_name, row_id, sheet_row) VALUES (?, ?, ?)",
+                        [(table, int(row[index]), i + 2) for i, row in enumerate(rows) if row[index].isdigit()]
+                    )
+                    cursor.execute(
+                        "INSERT OR REPLACE INTO backup_sheet_columns (table_name, columns) VALUES (?, ?)",
+                        (table, json.dumps(columns))
+                    )
             print(f"✅ `{table}` 読み込み完了")
         except Exception as e:
             print(f"❌ エラー（{table}）: {e}")
+            failed_tables.append(table)
             continue
 
+    if failed_tables:
+        # 一部だけ復元したDBで起動すると、古いテーブルがスナップショットやシートに書き戻されてしまう。
+        # 読み込んだ分も含めてすべて取り消し、起動を止める
+        conn.rollback()
+        conn.close()
+        raise RuntimeError(f"スプレッドシートから復元できませんでした（失敗: {', '.join(failed_tables)}）")
+
+    # 復元で発火したトリガーの記録は、シートと同じ内容なので破棄する
+    cursor.execute("DELETE FROM backup_changes")
+    # 集計表はバックアップしていないので、復元したデータから作り直す（初回はマイグレーションで作られる）
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'leaderboard'")
+    if cursor.fetchone():
+        rebuild_leaderboard(conn)
     conn.commit()
     conn.close()
+    # users も入れ替わるので、覚えているログインユーザーは読み直させる
+    invalidate_user_cache()
+    clear_fragments()
+    save_last_backup_time(fetch_sheet_backup_time())
     print("✅ 全テーブルの読み込み完了")
     
-load_backup_from_sheet()
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def write_local_snapshot():
+    """
+    現在のDBをスナップショットとして書き出し、チェックサムを横に保存します。
+    バックアップAPIを使うので、書き込み中のDBからでも一貫したコピーが取れます。
+    """
+    tmp_path = SNAPSHOT_PATH + ".tmp"
+    try:
+        src = sqlite3.connect(DB_NAME)
+        dst = sqlite3.connect(tmp_path)
+        with dst:
+            src.backup(dst)
+        dst.close()
+        src.close()
+        checksum = file_sha256(tmp_path)
+        os.replace(tmp_path, SNAPSHOT_PATH)
+        with open(SNAPSHOT_PATH + ".sha256", 'w') as f:
+            f.write(checksum)
+        print(f"💾 スナップショットを保存しました（{checksum[:12]}）")
+    except Exception as e:
+        print(f"⚠️ スナップショット保存エラー: {e}")
+
+def verify_local_snapshot():
+    # チェックサムが一致し、古すぎないスナップショットだけを使う
+    if not os.path.exists(SNAPSHOT_PATH) or not os.path.exists(SNAPSHOT_PATH + ".sha256"):
+        return False
+    if SNAPSHOT_MAX_AGE and time.time() - os.path.getmtime(SNAPSHOT_PATH) > SNAPSHOT_MAX_AGE:
+        print("⚠️ スナップショットが古いため使用しません。")
+        return False
+    with open(SNAPSHOT_PATH + ".sha256") as f:
+        expected = f.read().strip()
+    if file_sha256(SNAPSHOT_PATH) != expected:
+        print("⚠️ スナップショットのチェックサムが一致しません。")
+        return False
+    return True
+
+def is_local_db_healthy():
+    if not os.path.exists(DB_NAME):
+        return False
+    try:
+        conn = sqlite3.connect(DB_NAME)
+        ok = conn.execute("PRAGMA quick_check").fetchone()[0] == 'ok'
+        conn.close()
+        return ok
+    except sqlite3.DatabaseError:
+        return False
+
+# スキーマの変更は (バージョン, 名前, SQL文のリスト) で追加していく。適用済みかは schema_migrations で管理
+MIGRATIONS = [
+    (1, "hot_path_indexes", [
+        # カレンダー・今週のレース・月間ランキングの日付範囲検索
+        "CREATE INDEX IF NOT EXISTS idx_race_schedule_date ON race_schedule (race_date, start_time)",
+        # マイページ・ランキング集計。username 順に読めば GROUP BY もそのまま済む
+        "CREATE INDEX IF NOT EXISTS idx_raise_horse_username ON raise_horse (username, race_id, honmeiba_rank, score)",
+        # 出馬表（確定後）
+        "CREATE INDEX IF NOT EXISTS idx_race_entries_race_id ON race_entries (race_id, horse_number, horse_name)",
+    ]),
+    (2, "leaderboard", [
+        # ユーザー×期間×グレード×競馬場ごとの成績集計。'*' は「すべて」を表す
+        """
+        CREATE TABLE IF NOT EXISTS leaderboard (
+            period TEXT NOT NULL,
+            race_grade TEXT NOT NULL,
+            race_place TEXT NOT NULL,
+            username TEXT NOT NULL,
+            total_races INTEGER NOT NULL DEFAULT 0,
+            total_score INTEGER NOT NULL DEFAULT 0,
+            first INTEGER NOT NULL DEFAULT 0,
+            second INTEGER NOT NULL DEFAULT 0,
+            third INTEGER NOT NULL DEFAULT 0,
+            bbs INTEGER NOT NULL DEFAULT 0,
+            out_of_place INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (period, race_grade, race_place, username)
+        ) WITHOUT ROWID
+        """,
+        lambda conn: rebuild_leaderboard(conn),
+    ]),
+    (3, "data_versions", [
+        lambda conn: setup_data_versions(conn),
+    ]),
+    (4, "scoring_period_rules", [
+        # 除外レース・別月への加算をコードからルール表に移す
+        lambda conn: seed_period_rules(conn),
+        lambda conn: rebuild_leaderboard(conn),
+    ]),
+    (5, "schedule_version", [
+        # カレンダー・今週のレースのキャッシュを、開催日程の変更で作り直すため
+        lambda conn: setup_schedule_version(conn),
+    ]),
+    (6, "race_schedule_natural_key", [
+        # 以前の import_csv.py が見出し行をレースとして取り込んでいたので消す
+        "DELETE FROM race_schedule WHERE race_date = 'race_date'",
+        # CSV取り込みで (開催日, 競馬場, レース番号) から既存のレースを探す
+        "CREATE INDEX IF NOT EXISTS idx_race_schedule_natural_key ON race_schedule (race_date, race_place, race_number)",
+    ]),
+    (7, "race_schedule_keyset", [
+        # 予定追加画面の一覧を (race_date, id) の順にページ送りする（id は rowid なので索引に含まれる）
+        "CREATE INDEX IF NOT EXISTS idx_race_schedule_race_date ON race_schedule (race_date)",
+    ]),
+    (8, "page_versions", [
+        # 動画の差し替えでレースの版数を、成績の集計で 'leaderboard' を上げて、ページの ETag に使う
+        lambda conn: setup_page_versions(conn),
+    ]),
+]
+
+def run_migrations(conn):
+    """未適用のマイグレーションを、1つずつトランザクションで適用します。"""
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at REAL NOT NULL
+        )
+    """)
+    conn.commit()
+    cursor.execute("SELECT version FROM schema_migrations")
+    applied = {row[0] for row in cursor.fetchall()}
+
+    for version, name, statements in MIGRATIONS:
+        if version in applied:
+            continue
+        try:
+            cursor.execute("BEGIN")
+            for statement in statements:
+                # 文字列はそのまま実行、関数はデータの作り直しなどに使う
+                if callable(statement):
+                    statement(conn)
+                else:
+                    cursor.execute(statement)
+            cursor.execute(
+                "INSERT INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)",
+                (version, name, time.time())
+            )
+            conn.commit()
+            print(f"🛠 マイグレーション {version:03d}_{name} を適用しました")
+        except Exception as e:
+            conn.rollback()
+            print(f"❌ マイグレーション {version:03d}_{name} でエラー: {e}")
+            raise
+
+def read_boot_marker():
+    # マーカーは「デプロイID 時刻」の1行。読めなければ None
+    try:
+        with open(BOOT_MARKER_PATH) as f:
+            return f.read().split()[0]
+    except (OSError, IndexError):
+        return None
+
+def boot_database():
+    """
+    起動時のDB準備。ファイルロックで1プロセスだけが実行し、結果をマーカーに残します。
+      1. マーカーのデプロイIDが今のデプロイと同じで、ローカルDBが正常 → そのまま使う（2つ目以降のワーカーや再起動）
+      2. チェックサムの合うスナップショットがある → それをコピーして使う
+      3. どちらもない → スプレッドシートから復元してスナップショットを作る
+         （読めないテーブルがあれば例外で起動を止め、スナップショットもマーカーも作らない）
+    マーカーにはデプロイIDを書いておくので、ディスクが残る環境でも
+    新しいデプロイでは必ず 2 か 3 を通ります。
+    """
+    lock_file = open(BOOT_LOCK_PATH, 'w')
+    try:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        local_db_healthy = is_local_db_healthy()
+        if read_boot_marker() == DEPLOY_ID and local_db_healthy:
+            print("⚡ ローカルDBで起動します。")
+        elif BOOT_MODE != 'sheets' and verify_local_snapshot():
+            print("⚡ スナップショットから起動します。")
+            # 古いDBの WAL が残っていると、コピーしたDBに混ざってしまう
+            for suffix in ("-wal", "-shm"):
+                if os.path.exists(DB_NAME + suffix):
+                    os.remove(DB_NAME + suffix)
+            shutil.copyfile(SNAPSHOT_PATH, DB_NAME)
+        elif BOOT_MODE == 'snapshot':
+            if not local_db_healthy:
+                # 空のDBにマイグレーションを当てて起動すると、後の読み込みで分かりにくく失敗する
+                raise RuntimeError(
+                    f"BOOT_MODE=snapshot ですが、有効なスナップショット（{SNAPSHOT_PATH}）も"
+                    f"正常なローカルDB（{DB_NAME}）もありません。BOOT_MODE=auto で起動してください。"
+                )
+            print("⚠️ 有効なスナップショットがありません。ローカルDBのまま起動します。")
+        else:
+            load_backup_from_sheet()
+            write_local_snapshot()
+
+        conn = sqlite3.connect(DB_NAME)
+        setup_entry_tables(conn)
+        setup_period_rules(conn)
+        setup_change_tracking(conn)
+        setup_backup_queue(conn)
+        setup_race_video_table(conn)
+        run_migrations(conn)
+        conn.close()
+
+        with open(BOOT_MARKER_PATH, 'w') as f:
+            f.write(f"{DEPLOY_ID} {time.time()}")
+    finally:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+# 最後にバックアップした時刻（プロセス内キャッシュ。None ならまだ読んでいない）
+last_backup_time = None
+
+def save_last_backup_time(value):
+    global last_backup_time
+    last_backup_time = value
+    conn = connect_db()
+    conn.execute(
+        "INSERT OR REPLACE INTO backup_meta (key, value) VALUES ('last_backup_time', ?)", (str(value),)
+    )
+    conn.commit()
+    conn.close()
 
 def get_last_backup_time():
+    # スプレッドシートは見に行かず、プロセス内の値かローカルの backup_meta から返す
+    global last_backup_time
+    if last_backup_time is not None:
+        return last_backup_time
+    try:
+        conn = connect_db()
+        row = conn.execute("SELECT value FROM backup_meta WHERE key = 'last_backup_time'").fetchone()
+        conn.close()
+        last_backup_time = float(row[0]) if row and row[0] else 0.0
+    except Exception as e:
+        print(f"⚠️ タイムスタンプ取得エラー: {e}")
+        return 0.0
+    return last_backup_time
+
+def fetch_sheet_backup_time():
+    # 復元時だけ、スプレッドシート側の最終バックアップ時刻を取り込む
     try:
-        sheet = get_sheet_client()
-        worksheet = sheet.worksheet("timestamp")
-        value = worksheet.acell('A1').value
+        value = get_worksheet("timestamp").acell('A1').value
         return float(value) if value else 0.0
     except Exception as e:
         print(f"⚠️ タイムスタンプ取得エラー: {e}")
         return 0.0
-        
+
 def update_backup_time():
+    now = time.time()
+    save_last_backup_time(now)
     try:
-        sheet = get_sheet_client()
-        worksheet = sheet.worksheet("timestamp")
-        now = str(time.time())
-        worksheet.update_acell('A1', now)
+        worksheet = get_worksheet("timestamp")
+        worksheet.update_acell('A1', str(now))
     except Exception as e:
         print(f"⚠️ タイムスタンプ更新エラー: {e}")
             
-def run_backup_async():
-    thread = threading.Thread(target=backup_all_tables)
-    thread.start()
-    
+def setup_backup_queue(conn):
+    """
+    バックアップ要求をDBに積むためのテーブル。
+    プロセスが落ちても未処理の要求が残るので、再起動後にそのまま続きから同期できます。
+    """
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS backup_jobs (
+            id INTEGER PRIMARY KEY,
+            requested_at REAL NOT NULL,
+            force INTEGER NOT NULL DEFAULT 0,
+            claimed_by TEXT,
+            claimed_at REAL
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS backup_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    """)
+    conn.commit()
+
+def enqueue_backup(force=False):
+    conn = connect_db()
+    conn.execute(
+        "INSERT INTO backup_jobs (requested_at, force) VALUES (?, ?)",
+        (time.time(), 1 if force else 0)
+    )
+    conn.commit()
+    conn.close()
+    ensure_backup_worker()
+    with backup_condition:
+        backup_condition.notify()
+
+def next_backup_wait(cursor):
+    """
+    次の同期までの待ち秒数を返します（要求がなければ None）。
+    通常の要求は BACKUP_INTERVAL、強制の要求は BACKUP_FORCE_DELAY の間だけ
+    後続の要求を待ってから、まとめて1回の同期にします。
+    直前の同期が失敗していれば、新しい要求があっても再試行の時刻までは待ちます。
+    """
+    now = time.time()
+    cursor.execute("""
+        SELECT MIN(requested_at), MAX(force) FROM backup_jobs
+        WHERE claimed_by IS NULL OR claimed_at < ?
+    """, (now - BACKUP_LEASE_SECONDS,))
+    oldest, force = cursor.fetchone()
+    if oldest is None:
+        return None
+    window = BACKUP_FORCE_DELAY if force else BACKUP_INTERVAL
+    cursor.execute("SELECT value FROM backup_meta WHERE key = 'sync_retry_at'")
+    row = cursor.fetchone()
+    retry_at = float(row[0]) if row else 0.0
+    return max(0.0, oldest + window - now, retry_at - now)
+
+def backup_worker_id():
+    # fork 後に変わるので毎回作る
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def claim_backup_jobs(conn):
+    """
+    他のプロセスが同期中でなければ、溜まっている要求をすべて自分の担当にします。
+    """
+    now = time.time()
+    worker_id = backup_worker_id()
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    cursor.execute("""
+        SELECT COUNT(*) FROM backup_jobs
+        WHERE claimed_by IS NOT NULL AND claimed_by != ? AND claimed_at >= ?
+    """, (worker_id, now - BACKUP_LEASE_SECONDS))
+    if cursor.fetchone()[0]:
+        conn.rollback()
+        return 0
+    cursor.execute("""
+        UPDATE backup_jobs SET claimed_by = ?, claimed_at = ?
+        WHERE claimed_by IS NULL OR claimed_at < ?
+    """, (worker_id, now, now - BACKUP_LEASE_SECONDS))
+    claimed = cursor.rowcount
+    conn.commit()
+    return claimed
+
+def run_backup_jobs(conn):
+    """担当にできた要求の件数を返します（他のプロセスが同期中なら 0）。"""
+    claimed = claim_backup_jobs(conn)
+    if not claimed:
+        return 0
+    worker_id = backup_worker_id()
+    started = time.time()
+    ok = backup_all_tables()
+    finished = time.time()
+    cursor = conn.cursor()
+    if ok:
+        cursor.execute("DELETE FROM backup_jobs WHERE claimed_by = ?", (worker_id,))
+        failures = 0
+        retry_at = 0.0
+    else:
+        # 失敗したら担当を外し、強制も解いてやり直す。続けて失敗するほど間隔を倍々に延ばす
+        cursor.execute("SELECT value FROM backup_meta WHERE key = 'sync_failures'")
+        row = cursor.fetchone()
+        failures = (int(row[0]) if row else 0) + 1
+        retry_at = finished + min(BACKUP_INTERVAL * 2 ** (failures - 1), BACKUP_RETRY_MAX)
+        cursor.execute(
+            "UPDATE backup_jobs SET claimed_by = NULL, claimed_at = NULL, force = 0, requested_at = ? WHERE claimed_by = ?",
+            (finished, worker_id)
+        )
+        print(f"⏳ バックアップを{round(retry_at - finished)}秒後に再試行します（{failures}回連続の失敗）")
+    cursor.executemany(
+        "INSERT OR REPLACE INTO backup_meta (key, value) VALUES (?, ?)",
+        [
+            ('last_sync_latency', str(round(finished - started, 3))),
+            ('last_sync_finished_at', str(finished)),
+            ('last_sync_jobs', str(claimed)),
+            ('last_sync_ok', '1' if ok else '0'),
+            ('sync_failures', str(failures)),
+            ('sync_retry_at', str(retry_at)),
+        ]
+    )
+    conn.commit()
+    return claimed
+
+def backup_worker_loop():
+    conn = connect_db()
+    while True:
+        try:
+            # 動画URLの索引もこのワーカーで定期的に取り込む
+            video_wait = race_video_refresh_wait(conn.cursor())
+            if video_wait <= 0:
+                refresh_race_videos(conn)
+                continue
+            wait = next_backup_wait(conn.cursor())
+            if wait is None:
+                # 他のワーカーが積んだ要求や、落ちる前に残った要求も拾えるように定期的に見に行く
+                wait = BACKUP_IDLE_POLL
+            elif wait <= 0:
+                if run_backup_jobs(conn):
+                    continue
+                # 他のプロセスが同期中。すぐに取り直すと書き込みロックを奪い合うので、しばらく待つ
+                wait = BACKUP_IDLE_POLL
+            wait = min(wait, video_wait)
+            with backup_condition:
+                backup_condition.wait(timeout=wait)
+        except Exception as e:
+            print(f"❌ バックアップワーカーエラー: {e}")
+            # 途中で止まったトランザクションが書き込みロックを握ったままにならないよう取り消す
+            conn.rollback()
+            time.sleep(BACKUP_IDLE_POLL)
+
+def ensure_backup_worker():
+    # gunicorn の fork 後はスレッドが引き継がれないので、プロセスごとに1本だけ起動する
+    global backup_worker_thread
+    with backup_condition:
+        if backup_worker_thread is None or not backup_worker_thread.is_alive():
+            backup_worker_thread = threading.Thread(target=backup_worker_loop, name="backup-worker", daemon=True)
+            backup_worker_thread.start()
+
+def backup_status():
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute("SELECT COUNT(*) FROM backup_jobs")
+    queue_depth = cursor.fetchone()[0]
+    cursor.execute("SELECT COUNT(*) FROM backup_changes")
+    pending_changes = cursor.fetchone()[0]
+    cursor.execute("SELECT key, value FROM backup_meta")
+    meta = dict(cursor.fetchall())
+    conn.close()
+    return {
+        "queue_depth": queue_depth,
+        "pending_changes": pending_changes,
+        "last_sync_latency": float(meta.get('last_sync_latency', 0)),
+        "last_sync_finished_at": float(meta.get('last_sync_finished_at', 0)),
+        "last_sync_jobs": int(meta.get('last_sync_jobs', 0)),
+        "last_sync_ok": meta.get('last_sync_ok') == '1',
+        "sync_failures": int(meta.get('sync_failures', 0)),
+    }
+
 def startup_backup_check():
+    ensure_backup_worker()
     if SKIP_STARTUP_BACKUP:
         print("🚫 起動時のバックアップはスキップされました。")
         return
-    if time.time() - get_last_backup_time() >= BACKUP_INTERVAL:
-        run_backup_async()
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute("SELECT COUNT(*) FROM backup_jobs")
+    pending_jobs = cursor.fetchone()[0]
+    cursor.execute("SELECT COUNT(*) FROM backup_changes")
+    pending_changes = cursor.fetchone()[0]
+    conn.close()
+    if pending_jobs:
+        print(f"🔁 未処理のバックアップ要求 {pending_jobs} 件から再開します。")
+    elif pending_changes or time.time() - get_last_backup_time() >= BACKUP_INTERVAL:
+        enqueue_backup()
+
+# 同期処理そのものの排他（同じプロセス内で2本同時に走らせない）
+backup_lock = threading.Lock()
+backup_condition = threading.Condition()
+backup_worker_thread = None
+
+def to_sheet_value(value):
+    # None のままだと既存のセルが上書きされないので空文字にする
+    return '' if value is None else value
+
+def rewrite_worksheet(cursor, worksheet, table):
+    """テーブル全体をシートに書き直し、行番号の対応を作り直します。"""
+    cursor.execute(f"SELECT rowid, * FROM {table} ORDER BY rowid")
+    rows = cursor.fetchall()
+    column_names = [desc[0] for desc in cursor.description][1:]
+
+    worksheet.clear()
+    data = [column_names] + [[to_sheet_value(value) for value in row[1:]] for row in rows]
+    worksheet.update('A1', data)
+
+    if table in TRACKED_TABLES:
+        cursor.execute("DELETE FROM backup_sheet_rows WHERE table_name = ?", (table,))
+        cursor.executemany(
+            "INSERT INTO backup_sheet_rows (table_name, row_id, sheet_row) VALUES (?, ?, ?)",
+            [(table, row[0], i + 2) for i, row in enumerate(rows)]
+        )
+        cursor.execute(
+            "INSERT OR REPLACE INTO backup_sheet_columns (table_name, columns) VALUES (?, ?)",
+            (table, json.dumps(column_names))
+        )
+    print(f"📄 `{table}` を全件書き直しました（{len(rows)}行）")
+
+def push_changed_rows(cursor, worksheet, table, row_ids):
+    """変更された行だけを、シート上の対応する行に batch_update で書き込みます。"""
+    cursor.execute(
+        "SELECT row_id, sheet_row FROM backup_sheet_rows WHERE table_name = ?", (table,)
+    )
+    sheet_rows = dict(cursor.fetchall())
+    next_row = max(sheet_rows.values(), default=1) + 1
+
+    updates = []
+    new_rows = []
+    for i in range(0, len(row_ids), BACKUP_BATCH_SIZE):
+        chunk = row_ids[i:i + BACKUP_BATCH_SIZE]
+        placeholders = ', '.join(['?'] * len(chunk))
+        cursor.execute(f"SELECT rowid, * FROM {table} WHERE rowid IN ({placeholders})", chunk)
+        for row in cursor.fetchall():
+            row_id = row[0]
+            if row_id not in sheet_rows:
+                sheet_rows[row_id] = next_row
+                next_row += 1
+                new_rows.append((table, row_id, sheet_rows[row_id]))
+            updates.append((sheet_rows[row_id], [to_sheet_value(value) for value in row[1:]]))
+
+    if not updates:
+        return
 
-startup_backup_check()
+    # 新しい行がシートの行数を超える場合は先に行を追加しておく
+    if next_row - 1 > worksheet.row_count:
+        worksheet.add_rows(next_row - 1 - worksheet.row_count)
+
+    # 連続した行はひとつの範囲にまとめる
+    updates.sort(key=lambda x: x[0])
+    ranges = []
+    for sheet_row, values in updates:
+        if ranges and ranges[-1]['end'] + 1 == sheet_row:
+            ranges[-1]['end'] = sheet_row
+            ranges[-1]['values'].append(values)
+        else:
+            ranges.append({'start': sheet_row, 'end': sheet_row, 'values': [values]})
 
-# バックアップ中かどうかのフラグ（グローバル）
-is_backup_running = False
-def backup_all_tables():
-    global is_backup_running
+    width = len(updates[0][1])
+    data = [
+        {
+            'range': f"{rowcol_to_a1(r['start'], 1)}:{rowcol_to_a1(r['end'], width)}",
+            'values': r['values']
+        }
+        for r in ranges
+    ]
+    for i in range(0, len(data), BACKUP_BATCH_SIZE):
+        worksheet.batch_update(data[i:i + BACKUP_BATCH_SIZE])
+    # 行番号の対応は、シートへの書き込みが済んでから記録する
+    cursor.executemany(
+        "INSERT INTO backup_sheet_rows (table_name, row_id, sheet_row) VALUES (?, ?, ?)", new_rows
+    )
+    print(f"📄 `{table}` の差分を書き込みました（{len(updates)}行 / {len(ranges)}範囲）")
 
-    if is_backup_running:
+def backup_all_tables():
+    if not backup_lock.acquire(blocking=False):
         print("⚠️ バックアップはすでに実行中です。スキップします。")
-        return
+        return False
 
-    is_backup_running = True
     print(f"✅ バックアップ開始...（{datetime.now()}）")
+    conn = None
+    ok = False
+    failed_tables = []
 
     try:
-        sheet = get_sheet_client()  # ← あなたのGoogle Sheets認証関数
-        conn = sqlite3.connect(DB_NAME)
+        conn = connect_db()
         cursor = conn.cursor()
+        setup_change_tracking(conn)
 
-        for table in TABLES:
-            try:
-                print(f"📄 テーブル `{table}` の処理中...")
-                worksheet = sheet.worksheet(table)
+        # ここまでに記録された変更だけを処理する（処理中の書き込みは次回に回る）
+        cursor.execute("SELECT MAX(seq) FROM backup_changes")
+        max_seq = cursor.fetchone()[0] or 0
 
-                cursor.execute(f"SELECT * FROM {table}")
-                rows = cursor.fetchall()
+        for table in TRACKED_TABLES:
+            try:
+                cursor.execute("""
+                    SELECT row_id, MAX(op = 'delete') FROM backup_changes
+                    WHERE table_name = ? AND seq <= ?
+                    GROUP BY row_id
+                """, (table, max_seq))
+                changes = cursor.fetchall()
+
+                cursor.execute(f"SELECT * FROM {table} LIMIT 0")
                 column_names = [desc[0] for desc in cursor.description]
+                cursor.execute("SELECT columns FROM backup_sheet_columns WHERE table_name = ?", (table,))
+                saved = cursor.fetchone()
+
+                # 列構成が変わった・対応表がない・削除がある場合だけ全件書き直す
+                needs_rewrite = (
+                    saved is None
+                    or json.loads(saved[0]) != column_names
+                    or any(deleted for _, deleted in changes)
+                )
+                if not needs_rewrite and not changes:
+                    continue
 
-                worksheet.clear()
-                data = [column_names] + [list(row) for row in rows]
-                worksheet.update('A1', data)
+                print(f"📄 テーブル `{table}` の処理中...")
+                worksheet = get_worksheet(table, create=True)
+                if needs_rewrite:
+                    rewrite_worksheet(cursor, worksheet, table)
+                else:
+                    push_changed_rows(cursor, worksheet, table, [row_id for row_id, _ in changes])
+                # 書き込めたテーブルの変更記録だけを消す
+                cursor.execute(
+                    "DELETE FROM backup_changes WHERE table_name = ? AND seq <= ?", (table, max_seq)
+                )
+                conn.commit()
 
             except Exception as e:
                 print(f"⚠️ エラー（{table}）: {e}")
+                failed_tables.append(table)
+                conn.rollback()
+                # シートが途中まで書かれているかもしれないので、次回は全件書き直させる
+                cursor.execute("DELETE FROM backup_sheet_columns WHERE table_name = ?", (table,))
+                conn.commit()
                 continue
 
-        update_backup_time()
-        print(f"✅ バックアップ完了（{datetime.now()}）")
+        # sqlite_sequence は数行しかないので、何か変更があった時だけ丸ごと送る
+        # （失敗したテーブルがあれば、再試行のたびに送り直さないよう成功するまで待つ）
+        if max_seq and not failed_tables and 'sqlite_sequence' in TABLES:
+            try:
+                rewrite_worksheet(cursor, get_worksheet('sqlite_sequence'), 'sqlite_sequence')
+            except Exception as e:
+                print(f"⚠️ エラー（sqlite_sequence）: {e}")
+                failed_tables.append('sqlite_sequence')
+
+        if failed_tables:
+            # 変更記録と要求は残して、次の周期でやり直す
+            print(f"⚠️ バックアップ未完了（失敗: {', '.join(failed_tables)}）")
+        else:
+            update_backup_time()
+            write_local_snapshot()
+            ok = True
+            print(f"✅ バックアップ完了（{datetime.now()}）")
 
     except Exception as e:
         print(f"❌ バックアップ全体エラー: {e}")
+        reset_sheet_client()
 
     finally:
-        is_backup_running = False
+        backup_lock.release()
         if conn:
             conn.close()
+    return ok
 
 def backup_on_post(force=False):
-    if force or (time.time() - get_last_backup_time() >= BACKUP_INTERVAL):
-        run_backup_async()
+    # 書き込みのたびに要求を積むだけ。まとめて同期するのはワーカーの仕事
+    enqueue_backup(force)
 
-def connect_db():
-    conn = sqlite3.connect('miyakeiba_app.db')
+class PooledConnection(sqlite3.Connection):
+    """
+    スレッドごとに使い回す接続。close() では実際には閉じず、
+    未コミットの変更はリクエスト終了時（release_db）に取り消します。
+    """
+    def close(self):
+        pass
+
+    def really_close(self):
+        super().close()
+
+db_local = threading.local()
+
+def open_db():
+    conn = sqlite3.connect(DB_NAME, factory=PooledConnection)
     conn.row_factory = sqlite3.Row
+    for pragma in DB_PRAGMAS:
+        conn.execute(pragma)
     return conn
 
+def connect_db():
+    # fork 前に開いた接続は子プロセスで使えないので、pid が変わったら開き直す
+    conn = getattr(db_local, 'conn', None)
+    if conn is None or db_local.pid != os.getpid():
+        conn = open_db()
+        db_local.conn = conn
+        db_local.pid = os.getpid()
+    if has_app_context():
+        g.db = conn
+    return conn
+
+@app.teardown_appcontext
+def release_db(exception):
+    conn = g.pop('db', None)
+    if conn is not None and conn.in_transaction:
+        conn.rollback()
+
 def hash_passward(password):
     return hashlib.sha256(passward.encode()).hexdigest()
 
@@ -203,28 +991,16 @@ def set_inistial_passwords(conn):
         cursor.execute("UPDATE users SET password = ? WHERE id = ?", (initial_password, user_id))
     conn.commit()
 
-class HolidayCalendar(calendar.HTMLCalendar):
-    def formatday(self, day, weekday):
-        if day == 0:
-            return '<td class="noday">&nbsp;</td>'
-        
-        current_date = date(self.year, self.month, day)
-        is_holiday = jpholiday.is_holiday(current_date)
-
-        classes = ['weekday']
-        if weekday == 5:
-            classes.append('sat')
-        elif weekday == 6:
-            classes.append('sun')
-        if is_holiday:
-            classes.append('holiday')
+@lru_cache(maxsize=None)
+def holidays_for_year(year):
+    # 祝日は年ごとに1回だけ jpholiday から引き、以降はセットで判定する
+    return frozenset(holiday for holiday, _ in jpholiday.year_holidays(year))
 
-        class_str = ' '.join(classes)
-        return f'<td class="{class_str}">{day}</td>'
-    
+class HolidayCalendar(calendar.HTMLCalendar):
     def formatmonth(self, year, month, withyear=True):
         self.year = year
         self.month = month
+        self.holidays = holidays_for_year(year)
         weeks = self.monthdays2calendar(year, month)
 
         html = []
@@ -243,8 +1019,7 @@ class HolidayCalendar(calendar.HTMLCalendar):
             return '<td class="noday">&nbsp;</td>'
         
         current_date = date(self.year, self.month, day)
-        today = date.today()
-        is_holiday = jpholiday.is_holiday(current_date)
+        is_holiday = current_date in self.holidays
 
         classes = ['weekday']
         if weekday == 5:
@@ -253,105 +1028,286 @@ class HolidayCalendar(calendar.HTMLCalendar):
             classes.append('sun')
         if is_holiday:
             classes.append('holiday')
-        if current_date == today:
-            classes.append('today')
 
         class_str = ' '.join(classes)
         return f'<td class="{class_str}"><span class="day-number">{day}</span></td>'
 
-def get_events_for_month(year, month):
-    conn = connect_db()
-    cursor = conn.cursor()
-    
+@lru_cache(maxsize=64)
+def month_calendar_html(year, month):
+    return HolidayCalendar(firstweekday=0).formatmonth(year, month)
+
+def render_calendar(year, month, today):
+    """
+    月のカレンダーHTMLは (年, 月) ごとに1回だけ作り、
+    表示のたびに今日の日付のセルにだけ today クラスを付けます。
+    """
+    html = month_calendar_html(year, month)
+    if (today.year, today.month) == (year, month):
+        cell = f'"><span class="day-number">{today.day}</span>'
+        html = html.replace(cell, f' today{cell}', 1)
+    return html
+
+@lru_cache(maxsize=1024)
+def race_date_labels(date_str):
+    # 表示用の日付（月間: 07/15(火)、今週: 07/15（火）)は日付ごとに1回だけ作る
+    date_obj = datetime.strptime(date_str, "%Y-%m-%d").date()
+    weekday_jpn = JAPANESE_WEEKDAYS[date_obj.weekday()]
+    return (
+        date_obj,
+        date_obj.strftime(f"%m/%d({weekday_jpn})"),
+        f"{date_obj.strftime('%m/%d')}（{weekday_jpn}）",
+    )
+
+def month_range(year, month):
     first_day = date(year, month, 1)
     if month == 12:
-        last_day = date(year + 1, 1, 1)
+        next_first_day = date(year + 1, 1, 1)
     else:
-        last_day = date(year, month + 1, 1)
+        next_first_day = date(year, month + 1, 1)
+    return first_day, next_first_day
 
-    first_day_str = first_day.strftime("%Y-%m-%d")
-    last_day_str = last_day.strftime("%Y-%m-%d")
+# 月ごとのレース一覧を (年, 月) 単位でプロセス内に保持します。
+# race_schedule が変わると data_versions の 'schedule' が上がり、次の読み込みで作り直されます。
+EVENT_CACHE_SIZE = 64
+event_cache = {}
+event_cache_lock = threading.Lock()
 
-    query = """
-        SELECT id, race_date, race_place, race_ground, race_distance, race_number, race_grade, race_name, start_time
-        FROM race_schedule
-        WHERE race_date BETWEEN ? AND ?
-        ORDER BY race_date ASC, start_time ASC
+def load_month_events(months):
     """
-
-    cursor.execute(query, (first_day_str, last_day_str))
-    rows = cursor.fetchall()
+    [(年, 月), ...] のレース一覧をまとめて返します。
+    キャッシュにない月だけを、日付範囲の OR で1回のクエリで読み込みます。
+    """
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute("SELECT version FROM data_versions WHERE name = 'schedule'")
+    row = cursor.fetchone()
+    version = row['version'] if row else 0
+
+    result = {}
+    missing = []
+    with event_cache_lock:
+        for key in dict.fromkeys(months):
+            cached = event_cache.get(key)
+            if cached and cached[0] == version:
+                result[key] = cached[1]
+            else:
+                missing.append(key)
+
+    if missing:
+        ranges = [month_range(year, month) for year, month in missing]
+        where = " OR ".join("(race_date >= ? AND race_date < ?)" for _ in ranges)
+        params = [day.isoformat() for bounds in ranges for day in bounds]
+        cursor.execute(f"""
+            SELECT id, race_date, race_place, race_ground, race_distance, race_number, race_grade, race_name, start_time
+            FROM race_schedule
+            WHERE {where}
+            ORDER BY race_date ASC, start_time ASC
+        """, params)
+        loaded = {key: [] for key in missing}
+        for row in cursor.fetchall():
+            date_obj, display_date, _ = race_date_labels(row['race_date'])
+            loaded[(date_obj.year, date_obj.month)].append({
+                'id': row['id'],
+                'race_date': row['race_date'],
+                'race_date_display': display_date,
+                'race_place': row['race_place'],
+                'race_ground': row['race_ground'],
+                'race_distance': row['race_distance'],
+                'race_number': row['race_number'],
+                'race_grade': row['race_grade'],
+                'race_name': row['race_name'],
+                'start_time': row['start_time']
+            })
+        with event_cache_lock:
+            for key, events in loaded.items():
+                event_cache.pop(key, None)
+                if len(event_cache) >= EVENT_CACHE_SIZE:
+                    event_cache.pop(next(iter(event_cache)))
+                event_cache[key] = (version, events)
+        result.update(loaded)
     conn.close()
+    return result
 
-    events = []
-    for row in rows:
-        date_str = row['race_date']
-
-        # 月日形式の加工（例：07/15）
-        date_obj = datetime.strptime(date_str, "%Y-%m-%d")
-        weekday_jpn = JAPANESE_WEEKDAYS[date_obj.weekday()]
-        display_date = date_obj.strftime(f"%m/%d({weekday_jpn})")
-
-        # この行は不要なので削除
-        # if display_date not in events:
-        #     events = []
-
-        events.append({
-            'id': row['id'],
-            'race_date': row['race_date'],
-            'race_date_display': display_date,
-            'race_place': row['race_place'],
-            'race_ground': row['race_ground'],
-            'race_distance': row['race_distance'],
-            'race_number': row['race_number'],
-            'race_grade': row['race_grade'],
-            'race_name': row['race_name'],
-            'start_time': row['start_time']
-        })
-
-    return events
+def week_months(today):
+    start_of_week = today - timedelta(days=today.weekday())
+    end_of_week = start_of_week + timedelta(days=6)
+    return [(start_of_week.year, start_of_week.month), (end_of_week.year, end_of_week.month)]
 
-def get_this_week_races():
-    today = date.today()
+def get_this_week_races(today, month_events=None):
+    """今週（月〜日）のレース。month_events を渡すと、読み込み済みの月のデータから作ります。"""
     start_of_week = today - timedelta(days=today.weekday())
     end_of_week = start_of_week + timedelta(days=6)
-    conn = connect_db()
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT id, race_date, race_name, race_place, race_ground, race_distance, race_grade
-        FROM race_schedule
-        WHERE race_date BETWEEN ? AND ?
-        ORDER BY race_date, start_time
-    """,(start_of_week.isoformat(), end_of_week.isoformat()))
-    rows = cursor.fetchall()
-    conn.close()
+    months = week_months(today)
+    if month_events is None:
+        month_events = load_month_events(months)
+
     formatted_races = []
-    for row in rows:
-        date_obj = datetime.strptime(row["race_date"], "%Y-%m-%d")
-        weekday_jp = JAPANESE_WEEKDAYS[date_obj.weekday()]
-        formatted_date = f"{date_obj.strftime('%m/%d')}（{weekday_jp}）"
-        formatted_races.append({
-            "id": row["id"],
-            "race_date_display": formatted_date,
-            "race_name": row["race_name"],
-            "race_place": row["race_place"],
-            "race_ground": row["race_ground"],
-            "race_distance": row["race_distance"],
-            "race_grade": row["race_grade"]
-        })
+    for key in dict.fromkeys(months):
+        for event in month_events[key]:
+            date_obj, _, formatted_date = race_date_labels(event['race_date'])
+            if not start_of_week <= date_obj <= end_of_week:
+                continue
+            formatted_races.append({
+                "id": event["id"],
+                "race_date_display": formatted_date,
+                "race_name": event["race_name"],
+                "race_place": event["race_place"],
+                "race_ground": event["race_ground"],
+                "race_distance": event["race_distance"],
+                "race_grade": event["race_grade"]
+            })
     return formatted_races
 
+def group_events_by_date(events):
+    # 日付順に並んでいるので、1回なめるだけで日付ごとにまとまる
+    grouped = []
+    for event in events:
+        if grouped and grouped[-1][0] == event['race_date_display']:
+            grouped[-1][1].append(event)
+        else:
+            grouped.append((event['race_date_display'], [event]))
+    return grouped
+
+def get_leaderboard(conn, period='*', grade='*', place='*', limit=None):
+    query = """
+        SELECT
+            u.id AS user_id,
+            lb.username,
+            lb.total_races,
+            lb.total_score,
+            lb.first,
+            lb.second,
+            lb.third,
+            lb.bbs,
+            lb.out_of_place,
+            ROUND(lb.first * 1.0 / lb.total_races, 4) AS win_rate,
+            ROUND((lb.first + lb.second + lb.third) * 1.0 / lb.total_races, 4) AS placing_bets_rate
+        FROM leaderboard lb
+        LEFT JOIN users u ON lb.username = u.username
+        WHERE lb.period = ? AND lb.race_grade = ? AND lb.race_place = ?
+        ORDER BY
+            lb.total_score DESC,
+            lb.first DESC,
+            lb.second DESC,
+            lb.third DESC
+    """
+    params = [period, grade or '*', place or '*']
+    if limit:
+        query += " LIMIT ?"
+        params.append(limit)
+    return conn.execute(query, params).fetchall()
+
+# 成績表の1回の読み込み件数と、並べ替えできる列（APIの sort → SQL式）
+LEADERBOARD_PAGE_SIZE = 50
+LEADERBOARD_MAX_PAGE_SIZE = 200
+LEADERBOARD_SORT_COLUMNS = {
+    'username': 'lb.username',
+    'total_score': 'lb.total_score',
+    'first': 'lb.first',
+    'second': 'lb.second',
+    'third': 'lb.third',
+    'bbs': 'lb.bbs',
+    'out_of_place': 'lb.out_of_place',
+    'win_rate': 'lb.first * 1.0 / lb.total_races',
+    'placing_bets_rate': '(lb.first + lb.second + lb.third) * 1.0 / lb.total_races',
+}
+
+def get_leaderboard_page(conn, period='*', grade='*', place='*', sort='total_score', order='desc',
+                         offset=0, limit=LEADERBOARD_PAGE_SIZE):
+    """
+    集計表から1ページ分を返します。順位は並べ替えた列の値で付け、同じ値は同順位です。
+    戻り値は (該当するユーザー数, 行の辞書のリスト) です。
+    """
+    sort_expr = LEADERBOARD_SORT_COLUMNS.get(sort, LEADERBOARD_SORT_COLUMNS['total_score'])
+    direction = 'ASC' if order == 'asc' else 'DESC'
+    params = [period, grade or '*', place or '*']
+
+    total = conn.execute("""
+        SELECT COUNT(*) FROM leaderboard
+        WHERE period = ? AND race_grade = ? AND race_place = ?
+    """, params).fetchone()[0]
+    rows = conn.execute(f"""
+        SELECT
+            RANK() OVER (ORDER BY {sort_expr} {direction}) AS rank,
+            u.id AS user_id,
+            lb.username,
+            lb.total_races,
+            lb.total_score,
+            lb.first,
+            lb.second,
+            lb.third,
+            lb.bbs,
+            lb.out_of_place,
+            ROUND(lb.first * 1.0 / lb.total_races, 4) AS win_rate,
+            ROUND((lb.first + lb.second + lb.third) * 1.0 / lb.total_races, 4) AS placing_bets_rate
+        FROM leaderboard lb
+        LEFT JOIN users u ON lb.username = u.username
+        WHERE lb.period = ? AND lb.race_grade = ? AND lb.race_place = ?
+        ORDER BY
+            {sort_expr} {direction},
+            lb.total_score DESC,
+            lb.first DESC,
+            lb.second DESC,
+            lb.third DESC,
+            lb.username
+        LIMIT ? OFFSET ?
+    """, params + [limit, offset]).fetchall()
+    return total, [dict(row) for row in rows]
+
+@app.route('/api/leaderboard')
+def api_leaderboard():
+    """
+    成績表のJSON。?grade=G1&place=東京&sort=win_rate&order=asc&offset=50&limit=50
+    period は '*'（通算）か 'YYYY-MM'（月間）です。
+    """
+    sort = request.args.get('sort', 'total_score')
+    if sort not in LEADERBOARD_SORT_COLUMNS:
+        return jsonify({"error": f"sort に指定できない列です: {sort}"}), 400
+    order = 'asc' if request.args.get('order') == 'asc' else 'desc'
+    offset = max(request.args.get('offset', default=0, type=int), 0)
+    limit = min(max(request.args.get('limit', default=LEADERBOARD_PAGE_SIZE, type=int), 1),
+                LEADERBOARD_MAX_PAGE_SIZE)
+
+    conn = connect_db()
+    total, rows = get_leaderboard_page(
+        conn,
+        period=request.args.get('period') or '*',
+        grade=request.args.get('grade') or '*',
+        place=request.args.get('place') or '*',
+        sort=sort,
+        order=order,
+        offset=offset,
+        limit=limit
+    )
+    conn.close()
+    return jsonify({
+        "total": total,
+        "offset": offset,
+        "limit": limit,
+        "sort": sort,
+        "order": order,
+        "rows": rows
+    })
+
 @app.route('/')
 def home():
     JST = pytz.timezone('Asia/Tokyo')
     today = datetime.now(JST).date()
     year = today.year
     month = today.month
+
+    conn = connect_db()
+    schedule_version, leaderboard_version = read_data_versions(conn, ('schedule', 'leaderboard'))
+    etag = page_etag((schedule_version, leaderboard_version), today)
+    cached = not_modified(etag)
+    if cached:
+        conn.close()
+        return cached
     
-    events = get_events_for_month(year, month)
+    month_events = load_month_events([(year, month)] + week_months(today))
+    events = month_events[(year, month)]
 
-    cal = HolidayCalendar(firstweekday=0)
-    calendar_html = cal.formatmonth(year,month)
+    calendar_html = render_calendar(year, month, today)
 
     prev_month = month - 1
     prev_year = year
@@ -365,97 +1321,13 @@ def home():
         next_month = 1
         next_year += 1
 
-    start_date = f"{year}-{month:02d}-01"
-    end_day = monthrange(year, month)[1]
-    end_date = f"{year}-{month:02d}-{end_day}"
-
-    conn = connect_db()
-    cur = conn.cursor()
-    if year == 2025 and month == 10:
-        query = f"""
-            SELECT
-                u.id AS user_id,
-                rh.username,
-                SUM(rh.score) AS total_score,
-                SUM(CASE WHEN rh.honmeiba_rank = 1 THEN 1 ELSE 0 END) AS first,
-                SUM(CASE WHEN rh.honmeiba_rank = 2 THEN 1 ELSE 0 END) AS second,
-                SUM(CASE WHEN rh.honmeiba_rank = 3 THEN 1 ELSE 0 END) AS third
-            FROM raise_horse rh
-            JOIN race_schedule rs ON rh.race_id = rs.id
-            JOIN users u ON rh.username = u.username
-            WHERE 
-                /* 以下のいずれかを満たすレコードを集計対象とする */
-                (
-                    /* 1. 通常の集計対象期間内のレコード（除外リスト適用） */
-                    rs.race_date BETWEEN ? AND ? 
-                    AND rh.race_id NOT IN (24,25,26,27,28,29,30,31,32,33,34,35,36,37,38)
-                )
-                OR
-                (
-                    /* 2. 例外として、期間に関係なくレースID 2 を加算 */
-                    rh.race_id = 2 
-                )
-            GROUP BY rh.username
-            ORDER BY 
-                total_score DESC,
-                first DESC,
-                second DESC,
-                third DESC
-            LIMIT 3
-        """
-        # プレースホルダはWHERE句の BETWEEN ? AND ? で使われる2個のみ
-        cur.execute(query, (start_date, end_date))
-    else:
-        # 2025年10月以外の月は、通常の集計ロジック（レースID 2 は加算しない）
-        query = f"""
-            SELECT
-                u.id AS user_id,
-                rh.username,
-                SUM(rh.score) AS total_score,
-                SUM(CASE WHEN rh.honmeiba_rank = 1 THEN 1 ELSE 0 END) AS first,
-                SUM(CASE WHEN rh.honmeiba_rank = 2 THEN 1 ELSE 0 END) AS second,
-                SUM(CASE WHEN rh.honmeiba_rank = 3 THEN 1 ELSE 0 END) AS third
-            FROM raise_horse rh
-            JOIN race_schedule rs ON rh.race_id = rs.id
-            JOIN users u ON rh.username = u.username
-            WHERE rs.race_date BETWEEN ? AND ? AND rh.race_id NOT IN (24,25,26,27,28,29,30,31,32,33,34,35,36,37,38)
-            GROUP BY rh.username
-            ORDER BY 
-                total_score DESC,
-                first DESC,
-                second DESC,
-                third DESC
-            LIMIT 3
-        """
-        cur.execute(query, (start_date, end_date))
-    users = cur.fetchall()
-    query_total = """
-        SELECT
-            u.id AS user_id,
-            rh.username,
-            SUM(rh.score) AS total_score,
-            SUM(CASE WHEN rh.honmeiba_rank = 1 THEN 1 ELSE 0 END) AS first,
-            SUM(CASE WHEN rh.honmeiba_rank = 2 THEN 1 ELSE 0 END) AS second,
-            SUM(CASE WHEN rh.honmeiba_rank = 3 THEN 1 ELSE 0 END) AS third
-        FROM raise_horse rh
-        JOIN race_schedule rs ON rh.race_id = rs.id
-        JOIN users u ON rh.username = u.username
-        WHERE rh.race_id NOT IN (24,25,26,27,28,29,30,31,32,33,34,35,36,37,38)
-        GROUP BY rh.username
-        ORDER BY 
-            total_score DESC,
-            first DESC,
-            second DESC,
-            third DESC
-        LIMIT 3
-    """
-    cur.execute(query_total)
-    users_total = cur.fetchall()
+    users = get_leaderboard(conn, period=f"{year}-{month:02d}", limit=3)
+    users_total = get_leaderboard(conn, limit=3)
     conn.close()
 
-    races = get_this_week_races()
+    races = get_this_week_races(today, month_events)
     
-    return render_template(
+    return etag_response(render_template(
         'home.html', 
         calendar_html=calendar_html, 
         year=year, 
@@ -467,74 +1339,106 @@ def home():
         events=events,
         users=users,
         users_total=users_total,
-        races=races)
+        races=races,
+        today=today,
+        schedule_version=schedule_version,
+        leaderboard_version=leaderboard_version), etag)
 
 
+# 登録済みレース一覧の1ページあたりの件数
+RACE_LIST_PAGE_SIZE = 50
+TIME_PATTERN = re.compile(r'^\d{2}:\d{2}$')
+
+def parse_race_form_rows(form):
+    """
+    予定追加フォームの各行を検証し、INSERT用のタプルのリストとエラーのリストを返します。
+    1行でもエラーがあれば、どの行も登録しません。
+    """
+    fields = ['race_date', 'race_place', 'race_ground', 'race_distance',
+              'race_number', 'race_grade', 'race_name', 'start_time']
+    columns = {field: form.getlist(f'{field}[]') for field in fields}
+    count = len(columns['race_date'])
+    if any(len(values) != count for values in columns.values()):
+        return [], ["フォームの行数がそろっていません"]
+
+    rows = []
+    errors = []
+    for i in range(count):
+        row = {field: columns[field][i].strip() for field in fields}
+        line = i + 1
+        try:
+            date.fromisoformat(row['race_date'])
+        except ValueError:
+            errors.append(f"{line}行目: 日付が不正です")
+        if not row['race_place'] or not row['race_name']:
+            errors.append(f"{line}行目: 開催とレース名は必須です")
+        for field in ('race_number', 'race_distance'):
+            if row[field] and not row[field].isdigit():
+                errors.append(f"{line}行目: {field} は数値で入力してください")
+        if row['start_time'] and not TIME_PATTERN.match(row['start_time']):
+            errors.append(f"{line}行目: 発走時刻は HH:MM で入力してください")
+        rows.append((
+            row['race_date'],
+            row['race_place'],
+            int(row['race_number']) if row['race_number'].isdigit() else None,
+            row['race_grade'],
+            row['race_name'],
+            row['start_time'] or None,
+            row['race_ground'],
+            int(row['race_distance']) if row['race_distance'].isdigit() else None
+        ))
+    return rows, errors
+
 @app.route('/insert_race', methods=['GET', 'POST'])
 def insert_race():
     if request.method == 'POST':
-        race_dates = request.form.getlist('race_date[]')
-        race_places = request.form.getlist('race_place[]')
-        race_ground = request.form.getlist('race_ground[]')
-        race_distance = request.form.getlist('race_distance[]')
-        race_numbers = request.form.getlist('race_number[]')
-        race_grades = request.form.getlist('race_grade[]')
-        race_names = request.form.getlist('race_name[]')
-        start_times = request.form.getlist('start_time[]')
+        rows, errors = parse_race_form_rows(request.form)
+        if errors:
+            for error in errors:
+                flash(error)
+            return redirect('/insert_race')
 
         conn = connect_db()
         cursor = conn.cursor()
-
-        for i in range(len(race_dates)):
-            cursor.execute("""
-                INSERT INTO race_schedule (race_date, race_place, race_number, race_grade, race_name, start_time, race_ground, race_distance)
-                VALUES (?,?,?,?,?,?,?,?)
-            """,(
-                race_dates[i],
-                race_places[i],
-                race_numbers[i] if race_numbers[i] else None,
-                race_grades[i],
-                race_names[i],
-                start_times[i] if start_times[i] else None,
-                race_ground[i],
-                race_distance[i]
-            ))
-
+        cursor.executemany("""
+            INSERT INTO race_schedule (race_date, race_place, race_number, race_grade, race_name, start_time, race_ground, race_distance)
+            VALUES (?,?,?,?,?,?,?,?)
+        """, rows)
         conn.commit()
+        backup_on_post(force=True)
         conn.close()
 
+        flash(f"{len(rows)}件のレースを追加しました")
         return redirect('/insert_race')
     
+    # 新しい順に (race_date, id) でページを区切る。次のページは最後の行より古いものから
+    before_date = request.args.get('before_date')
+    before_id = request.args.get('before_id', type=int)
+
     conn = connect_db()
     cursor = conn.cursor()
 
-    cursor.execute("""
+    query = """
         SELECT id, race_date, race_place, race_ground, race_distance, race_number, race_grade, race_name, start_time
         FROM race_schedule
-        ORDER BY race_date DESC
-    """)
+    """
+    params = []
+    if before_date and before_id is not None:
+        query += " WHERE (race_date, id) < (?, ?)"
+        params = [before_date, before_id]
+    query += " ORDER BY race_date DESC, id DESC LIMIT ?"
+    params.append(RACE_LIST_PAGE_SIZE + 1)
+    cursor.execute(query, params)
     rows = cursor.fetchall()
-    backup_on_post(force=True)
     conn.close()
 
-    races = []
-    for row in rows:
-        races.append({
-            "id": row['id'],
-            "race_date": row['race_date'],
-            "race_place": row['race_place'],
-            "race_ground": row['race_ground'],
-            "race_distance": row['race_distance'],
-            "race_number": row['race_number'],
-            "race_grade": row['race_grade'],
-            "race_name": row['race_name'],
-            "start_time": row['start_time']
-        })
-    
-    races.sort(key=lambda x: x['race_date'], reverse=True)
-    races = races[1:]
+    races = [dict(row) for row in rows[:RACE_LIST_PAGE_SIZE]]
+    next_page = None
+    if len(rows) > RACE_LIST_PAGE_SIZE:
+        next_page = {'before_date': races[-1]['race_date'], 'before_id': races[-1]['id']}
 
-    return render_template('insert_race.html', races=races)
+    return render_template('insert_race.html', races=races, next_page=next_page,
+                           is_first_page=before_date is None)
 
 @app.route('/delete_race', methods=['POST'])
 def delete_race():
@@ -542,6 +1446,7 @@ def delete_race():
 
     conn = connect_db()
     cursor = conn.cursor()
+    apply_leaderboard_delta(conn, [race_id], -1)
     cursor.execute("DELETE FROM race_schedule WHERE id = ?", (race_id,))
     conn.commit()
     backup_on_post(force=True)
@@ -549,6 +1454,13 @@ def delete_race():
 
     return redirect('/insert_race')
 
+@app.route('/backup_status')
+@login_required
+def show_backup_status():
+    if current_user.role != 'admin':
+        abort(403)
+    return jsonify(backup_status())
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     print("request.method:", request.method)
@@ -572,6 +1484,8 @@ def login():
             # User オブジェクトを作る
             user_obj = User(user['id'], user['username'], user['role'])
             login_user(user_obj)
+            if USER_CACHE_TTL > 0:
+                cache_user(user_obj)
             print("login_user 実行後:", current_user.is_authenticated)
             return redirect('/')
         else:
@@ -582,6 +1496,8 @@ def login():
 
 @app.route('/logout')
 def logout():
+    if current_user.is_authenticated:
+        invalidate_user_cache(current_user.get_id())
     logout_user()
     return redirect('/')
 
@@ -597,7 +1513,6 @@ def register():
         cursor = conn.cursor()
         try:
             cursor.execute("INSERT INTO users (username, password, role) VALUES (?, ?, ?)", (username, hashed_pw, 'user'))
-            backup_on_post()
             conn.commit()
         except sqlite3.IntegrityError:
             flash("ユーザー名は既に使われています")
@@ -606,46 +1521,50 @@ def register():
             conn.close()
 
         flash("登録に成功しました。ログインしてください。")
-        run_backup_async()
+        backup_on_post()
         return redirect('/login')
 
     return render_template('register.html')
 
-def save_to_sheet(sheet_name, race_id, horse_names):
-    print(f"🔍 save_to_sheet 実行: {sheet_name}")
-    sheet = get_sheet_client()
-    worksheet = sheet.worksheet(sheet_name)
-
-    try:
-        existing_data = worksheet.get_all_values()
-        current_max_id = 0
-        if len(existing_data) > 1:
-            try:
-                current_max_id = max(int(row[0]) for row in existing_data[1:] if row and row[0].isdigit())
-            except Exception as e:
-                print(f"⚠️ IDの取得に失敗: {e}")
-                current_max_id = 0
-    except Exception as e:
-        print(f"❌ スプレッドシートの取得エラー: {e}")
-        return
-
-    
-    rows = []
+def save_entries(mode, race_id, horse_names):
+    """
+    出馬表をローカルDBに保存します。同じレースの既存の行とは馬番で突き合わせ、
+    名前が変わった馬だけ更新し、いなくなった馬番だけ削除します（1トランザクション）。
+    行を作り直さないので、バックアップワーカーは変わった行だけをスプレッドシートに送れます。
+    """
+    table = "horseentrybefore" if mode == "before" else "race_entries"
+    names = {}
     for i, name in enumerate(horse_names, start=1):
         name = name.strip()
         if name:
-            current_max_id += 1
-            print(f"📄 書き込み予定: id={current_max_id}, race_id={race_id}, number={i}, name={name}")
-            rows.append([current_max_id, race_id, i, name])
+            names[i] = name
 
-    if rows:
-        try:
-            worksheet.append_rows(rows, value_input_option="USER_ENTERED")
-            print("✅ 書き込み成功")
-        except Exception as e:
-            print(f"❌ append_rows でエラー: {e}")
-    else:
-        print("⚠️ 書き込む行がありません")
+    conn = connect_db()
+    with conn:
+        cursor = conn.execute(
+            f"SELECT id, horse_number, horse_name FROM {table} WHERE race_id = ? ORDER BY id", (race_id,)
+        )
+        existing = {}
+        delete_ids = []
+        for row_id, horse_number, horse_name in cursor.fetchall():
+            if horse_number in names and horse_number not in existing:
+                existing[horse_number] = (row_id, horse_name)
+            else:
+                # 出走しなくなった馬番と、同じ馬番が重複して残っている行
+                delete_ids.append((row_id,))
+        conn.executemany(f"DELETE FROM {table} WHERE id = ?", delete_ids)
+        conn.executemany(
+            f"UPDATE {table} SET horse_name = ? WHERE id = ?",
+            [(name, existing[number][0]) for number, name in names.items()
+             if number in existing and existing[number][1] != name]
+        )
+        conn.executemany(
+            f"INSERT INTO {table} (race_id, horse_number, horse_name) VALUES (?, ?, ?)",
+            [(race_id, number, name) for number, name in names.items() if number not in existing]
+        )
+    conn.close()
+    print(f"✅ `{table}` に {len(names)} 頭を保存しました（race_id={race_id}）")
+    return len(names)
 
 @app.route('/entry_form', methods=['GET', 'POST'])
 def entry_form():
@@ -655,12 +1574,12 @@ def entry_form():
         horse_names = request.form.getlist('horse_name[]')
 
         try:
-            sheet_name = "horseentrybefore" if mode == "before" else "race_entries"
-            save_to_sheet(sheet_name, race_id, horse_names)
+            save_entries(mode, race_id, horse_names)
+            backup_on_post(force=True)
             if mode == 'before':
-                flash("枠順確定前の出馬表をスプレッドシートに保存しました")
+                flash("枠順確定前の出馬表を保存しました")
             else:
-                flash("枠順確定後の出馬表をスプレッドシートに保存しました")
+                flash("枠順確定後の出馬表を保存しました")
                 
             return redirect('/entry_form')
 
@@ -676,7 +1595,6 @@ def entry_form():
         ORDER BY race_date DESC
     """)
     races = cursor.fetchall()
-    races = races[1:]  # 必要なら
 
     conn.close()
 
@@ -696,20 +1614,29 @@ def get_friday_midnight(race_date_str):
     
     return friday_midnight
 
-def fetch_entries_from_sheet(race_id):
-    try:
-        sheet = get_sheet_client()
-        worksheet = sheet.worksheet("horseentrybefore")
-        all_rows = worksheet.get_all_values()
-        
-        # ヘッダーを除外
-        rows = [row for row in all_rows[1:] if row[1] == str(race_id)]
-        # データ整形
-        entries = [{"horse_name": row[3]} for row in rows]
-        return entries
-    except Exception as e:
-        print(f"❌ スプレッドシート取得エラー: {e}")
-        return []
+def setup_entry_tables(conn):
+    # 枠順確定前の出馬表。確定後の race_entries と同じ形で持つ
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS horseentrybefore (
+            id INTEGER PRIMARY KEY,
+            race_id INTEGER NOT NULL,
+            horse_number INTEGER NOT NULL,
+            horse_name TEXT NOT NULL
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_horseentrybefore_race_id ON horseentrybefore (race_id)")
+    conn.commit()
+
+def fetch_entries_before(race_id):
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT horse_name FROM horseentrybefore WHERE race_id = ? ORDER BY horse_number", (race_id,)
+    )
+    entries = [{"horse_name": row['horse_name']} for row in cursor.fetchall()]
+    conn.close()
+    return entries
 
 #@app.route('/entries/<int:race_id>', methods=['GET', 'POST'])
 #def show_entries(race_id):
@@ -885,9 +1812,9 @@ def result_input(race_id):
 
         update_scores(conn, race_id)
 
-        backup_on_post(force=True)
         conn.commit()
         conn.close()
+        backup_on_post(force=True)
         flash("レース結果を登録しました")
         return redirect(url_for('show_race_page', race_id=race_id))
 
@@ -902,91 +1829,17 @@ def result_input(race_id):
 
 # @app.route('/update_scores/<int:race_id>', methods=['POST'])
 def update_scores(conn, race_id):
+    """
+    レース結果から本命馬の着順・オッズ・得点を付け、投票したユーザーの成績を更新します。
+    採点そのものは scoring.rescore にまとめてあります。
+    """
     cur = conn.cursor()
-
-    # レース結果取得
-    cur.execute("""
-        SELECT first_place, second_place, third_place,
-        fourth_place, fifth_place,
-        odds_first, odds_second, odds_third
-        FROM race_result WHERE race_id = ?
-    """, (race_id,))
-    res = cur.fetchone()
-    if not res:
+    cur.execute("SELECT 1 FROM race_result WHERE race_id = ?", (race_id,))
+    if not cur.fetchone():
         flash("レース結果が未登録です")
         return
-    result = dict(res)
 
-    # 本命馬提出データ取得
-    cur.execute("""
-        SELECT username, honmeiba FROM raise_horse WHERE race_id = ?
-    """, (race_id,))
-    rows = cur.fetchall()
-
-    for username, honmeiba in rows:
-        rank = 0
-        odds = None
-        score = 0
-
-        if honmeiba == result['first_place']:
-            rank = 1
-            odds = result['odds_first']
-            score = round(odds * 10)
-        elif honmeiba == result['second_place']:
-            rank = 2
-            odds = result['odds_second']
-            score = round(odds * 3)
-        elif honmeiba == result['third_place']:
-            rank = 3
-            odds = result['odds_third']
-            score = round(odds * 1)
-        elif honmeiba == result['fourth_place']:
-            rank = 4
-        elif honmeiba == result['fifth_place']:
-            rank = 5
-
-        cur.execute("""
-            UPDATE raise_horse
-            SET honmeiba_rank = ?, honmeiba_odds = ?, score = ?
-            WHERE race_id = ? AND username = ?
-        """, (rank, odds, score, race_id, username))
-
-        if rank == 1:
-            cur.execute("UPDATE users set first = first + 1, score = score + ? WHERE username = ?", (score, username))
-        elif rank == 2:
-            cur.execute("UPDATE users SET second = second + 1, score = score + ? WHERE username = ?", (score, username))
-        elif rank == 3:
-            cur.execute("UPDATE users SET third = third + 1, score = score + ? WHERE username = ?", (score, username))
-        elif rank in [4, 5]:
-            cur.execute("UPDATE users SET bbs = bbs + 1 WHERE username = ?", (username,))
-        else:
-            cur.execute("UPDATE users SET out_of_place = out_of_place + 1 WHERE username = ?", (username,))
-    
-    cur.execute("SELECT username, first, second, third FROM users")
-    for user in cur.fetchall():
-        username = user["username"]
-        first = int(user["first"])
-        second = int(user["second"])
-        third = int(user["third"])
-
-        # raise_horseから提出回数を取得
-        cur.execute("SELECT COUNT(*) FROM raise_horse WHERE username = ?", (username,))
-        total_entries = cur.fetchone()[0]
-
-        if total_entries > 0:
-            win_rate = first / total_entries
-            placing_rate = (first + second + third) / total_entries
-        else:
-            win_rate = 0
-            placing_rate = 0
-
-        cur.execute("""
-            UPDATE users
-            SET win_rate = ?, placing_bets_rate = ?
-            WHERE username = ?
-        """, (win_rate, placing_rate, username))
-
-    backup_on_post()
+    rescore(conn, [race_id])
     conn.commit()
     flash("得点とユーザー情報を更新しました")
 
@@ -1062,184 +1915,276 @@ def update_scores(conn, race_id):
 #    conn.close()
 
 #    return render_template('race_result.html', race_id=race_id, horses=horses, race=race, result=result, scores=ranked_scores)
-def get_video_url(race_id):
-    try:
-        sh = get_sheet_client()
-        worksheet_name = 'race_video'
-        try:
-            worksheet = sh.worksheet(worksheet_name)
-        except WorksheetNotFound:
-            logging.error(f"シート名 '{worksheet_name}' が見つかりません。シート名を確認してください。")
-            return None
-
-        data = worksheet.get_all_records()
+YOUTUBE_REGEX = re.compile(
+    r'(?:https?:\/\/)?(?:www\.)?(?:youtube\.com\/(?:[^\/\n\s]+\/\S+\/|(?:v|e(?:mbed)?)\/|\S*?[?&]v=)|youtu\.be\/)([a-zA-Z0-9_-]{11})'
+)
 
-        for row in data:
-            try:
-                if int(row.get('id')) == race_id:
-                    video_url = row.get('url')
-                    if video_url:
-                        logging.info(f"レースID {race_id} の動画URLが見つかりました: {video_url}")
-                        return video_url
-            except (ValueError, TypeError):
-                continue
+def extract_youtube_id(url):
+    """
+    YouTube URLから動画IDを抽出します。
+    watch?v=xxx や youtu.be/xxx の両方に対応します。
+    """
+    match = YOUTUBE_REGEX.search(url)
+    return match.group(1) if match else None
 
-        logging.warning(f"レースID {race_id} に対応する動画URLがスプレッドシートに見つかりませんでした。")
-        return None
+def setup_race_video_table(conn):
+    # race_video シートのローカル索引。動画IDは取り込み時に抽出しておく
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS race_video (
+            race_id INTEGER PRIMARY KEY,
+            url TEXT NOT NULL,
+            youtube_id TEXT
+        )
+    """)
+    conn.commit()
 
+def refresh_race_videos(conn):
+    """
+    race_video シートを読み込んでローカルの索引を作り直します。
+    バックアップワーカーから RACE_VIDEO_REFRESH_INTERVAL ごとに呼ばれます。
+    """
+    cursor = conn.cursor()
+    # 失敗しても次の周期まで待つように、先に取得時刻を更新しておく
+    cursor.execute(
+        "INSERT OR REPLACE INTO backup_meta (key, value) VALUES ('race_video_fetched_at', ?)", (str(time.time()),)
+    )
+    conn.commit()
+    worksheet_name = 'race_video'
+    try:
+        data = get_worksheet(worksheet_name).get_all_records()
+    except WorksheetNotFound:
+        logging.error(f"シート名 '{worksheet_name}' が見つかりません。シート名を確認してください。")
+        return
     except SpreadsheetNotFound:
         logging.error(f"スプレッドシート名 '{SHEET_NAME}' が見つかりません。名前が正しいか確認してください。")
-        return None
+        return
     except Exception as e:
         logging.error(f"Google Sheetsへのアクセス中にエラーが発生しました: {e}")
-        return None
+        return
 
-def extract_youtube_id(url):
-    """
-    YouTube URLから動画IDを抽出します。
-    watch?v=xxx や youtu.be/xxx の両方に対応します。
-    """
-    youtube_regex = re.compile(
-        r'(?:https?:\/\/)?(?:www\.)?(?:youtube\.com\/(?:[^\/\n\s]+\/\S+\/|(?:v|e(?:mbed)?)\/|\S*?[?&]v=)|youtu\.be\/)([a-zA-Z0-9_-]{11})'
+    videos = []
+    for row in data:
+        try:
+            race_id = int(row.get('id'))
+        except (ValueError, TypeError):
+            continue
+        url = str(row.get('url') or '').strip()
+        if url:
+            videos.append((race_id, url, extract_youtube_id(url)))
+
+    # 変わった行だけを書き換えて、動画が同じレースの版数（ETag・表示キャッシュ）は上げない
+    new_videos = {race_id: (url, youtube_id) for race_id, url, youtube_id in videos}
+    cursor.execute("SELECT race_id, url FROM race_video")
+    current = {row[0]: row[1] for row in cursor.fetchall()}
+    cursor.executemany(
+        "DELETE FROM race_video WHERE race_id = ?",
+        [(race_id,) for race_id in current if race_id not in new_videos]
     )
-    match = youtube_regex.search(url)
-    return match.group(1) if match else None
+    cursor.executemany(
+        "INSERT OR REPLACE INTO race_video (race_id, url, youtube_id) VALUES (?, ?, ?)",
+        [(race_id, url, youtube_id) for race_id, (url, youtube_id) in new_videos.items()
+         if current.get(race_id) != url]
+    )
+    conn.commit()
+    logging.info(f"動画URLの索引を更新しました（{len(videos)}件）")
 
-@app.route('/race/<int:race_id>', methods=['GET', 'POST'])
-def show_race_page(race_id):
+def race_video_refresh_wait(cursor):
+    cursor.execute("SELECT value FROM backup_meta WHERE key = 'race_video_fetched_at'")
+    row = cursor.fetchone()
+    fetched_at = float(row[0]) if row else 0.0
+    return fetched_at + RACE_VIDEO_REFRESH_INTERVAL - time.time()
+
+def get_video_id(race_id):
     conn = connect_db()
-    cur = conn.cursor()
-    entries = []
+    cursor = conn.cursor()
+    cursor.execute("SELECT youtube_id FROM race_video WHERE race_id = ?", (race_id,))
+    row = cursor.fetchone()
+    conn.close()
+    return row['youtube_id'] if row else None
+
+# 表示データの版数を、対象テーブルのトリガーで data_versions に数えます。
+# 'race:<id>' は投票・出馬表・結果・動画のどれかが、'schedule' は開催日程が、
+# 'leaderboard' は成績の集計が変わるたびに 1 増えます。
+def create_race_version_triggers(cursor, table):
+    # 行が変わるたびに、そのレースの版数（'race:<race_id>'）を上げる
+    for event, ref in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_version
+            AFTER {event} ON {table}
+            BEGIN
+                INSERT INTO data_versions (name, version) VALUES ('race:' || {ref}.race_id, 1)
+                ON CONFLICT(name) DO UPDATE SET version = version + 1;
+            END
+        """)
+
+def create_global_version_triggers(cursor, table, name):
+    # 行が変わるたびに、表全体の版数（name）を上げる
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_version
+            AFTER {event} ON {table}
+            BEGIN
+                INSERT INTO data_versions (name, version) VALUES ('{name}', 1)
+                ON CONFLICT(name) DO UPDATE SET version = version + 1;
+            END
+        """)
+
+def setup_data_versions(conn):
+    # マイグレーション3: 版数の表と、出馬表・投票・結果からレースの版数を上げるトリガー
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    """)
+    for table in ('raise_horse', 'race_entries', 'horseentrybefore', 'race_result'):
+        create_race_version_triggers(cursor, table)
 
+def setup_schedule_version(conn):
+    # マイグレーション5: 開催日程の変更で 'schedule' を上げる
+    create_global_version_triggers(conn.cursor(), 'race_schedule', 'schedule')
+
+def setup_page_versions(conn):
+    # マイグレーション8: 動画の差し替えでレースの版数を、成績の集計で 'leaderboard' を上げる
     cursor = conn.cursor()
-    cursor.execute("SELECT id, race_date, race_place, race_name, start_time FROM race_schedule WHERE id = ?", (race_id,))
-    race = cursor.fetchone()
-    if not race:
-        conn.close()
-        flash("指定されたレースが見つかりません")
-        return redirect('/')
-    race = dict(race)
-    now = datetime.now(JST)
+    create_race_version_triggers(cursor, 'race_video')
+    create_global_version_triggers(cursor, 'leaderboard', 'leaderboard')
+
+def read_data_versions(conn, names):
+    """data_versions から版数をまとめて読む。まだ一度も書かれていない名前は 0。"""
+    placeholders = ', '.join('?' * len(names))
+    rows = conn.execute(
+        f"SELECT name, version FROM data_versions WHERE name IN ({placeholders})", list(names)
+    ).fetchall()
+    versions = dict.fromkeys(names, 0)
+    versions.update((row['name'], row['version']) for row in rows)
+    return tuple(versions[name] for name in names)
+
+# ページの ETag は、表示に使う版数・日時による状態・URL・ログインユーザー・デプロイから作ります。
+# 版数を読むだけで 304 を返せるので、描画に使う SQL やテンプレートは一致しない時だけ動きます。
+def page_etag(*parts):
+    viewer = (current_user.get_id(), current_user.role) if current_user.is_authenticated else None
+    key = repr((DEPLOY_ID, sorted(asset_manifest.values()), viewer, request.full_path) + parts)
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+def not_modified(etag):
+    """If-None-Match が一致すれば 304 のレスポンスを、そうでなければ None を返す。"""
+    if request.method != 'GET' or not request.if_none_match.contains(etag):
+        return None
+    return etag_response('', etag, status=304)
+
+def etag_response(body, etag, status=200):
+    response = make_response(body, status)
+    if request.method == 'GET':
+        response.set_etag(etag)
+        # ログインユーザーで中身が変わるので共有キャッシュには置かせず、毎回 ETag で確かめさせる
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+# レース画面の表示データ（出馬表・投票・結果・得点順位）をプロセス内に保持します。
+# 版数が変わっていなければ、確定したレースは何度開かれてもSQLを投げません。
+RACE_VIEW_CACHE_SIZE = 256
+race_view_cache = {}
+race_view_cache_lock = threading.Lock()
+
+# ユーザー画像・CSS・JS はURLに内容ハッシュが入るので、ブラウザには1年キャッシュさせる
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+IMMUTABLE_CACHE_CONTROL = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+
+# バンドル名 -> static/build/ のハッシュ入りファイル名（起動時に assets.build_all() で埋める）
+asset_manifest = {}
+
+@app.template_global()
+def asset_url(name):
+    """url_for('static', ...) の代わりに使う。assets.ASSET_BUNDLES のバンドル名からハッシュ入りのURLを返す。"""
+    return url_for('asset', filename=asset_manifest[name])
+
+@app.route('/assets/<filename>')
+def asset(filename):
+    if filename not in asset_manifest.values():
+        abort(404)
+    path = os.path.join(assets.ASSET_BUILD_DIR, filename)
+    mimetype = assets.ASSET_MIMETYPES[os.path.splitext(filename)[1]]
+    # 圧縮済みの版があれば、ブラウザが受け取れるもの（br → gzip の順）をそのまま返す
+    encoding = next((e for e in assets.encodings() if request.accept_encodings[e]), None)
+    if encoding:
+        path += assets.ASSET_ENCODINGS[encoding]
+    response = send_file(path, mimetype=mimetype, max_age=IMMUTABLE_MAX_AGE)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
+
+@app.template_global()
+def user_image_url(user_id, name, fmt='png'):
+    """縮小したユーザー画像のURL。元画像がない（またはその形式を作れない）時は None。"""
+    if not user_id or name not in images.IMAGE_VARIANTS or fmt not in images.image_formats():
+        return None
+    digest = images.source_hash(user_id, name)
+    if digest is None:
+        return None
+    return url_for('user_image', user_id=user_id,
+                   filename=images.variant_filename(name, digest, fmt))
+
+@app.route('/img/user/<int:user_id>/<filename>')
+def user_image(user_id, filename):
     try:
-        race_datetime_str = f"{race['race_date']} {race['start_time']}"
-        race_datetime = JST.localize(datetime.strptime(race_datetime_str, "%Y-%m-%d %H:%M"))
-        voting_deadline = race_datetime - timedelta(minutes=1)
-        cutoff_time = get_friday_midnight(race['race_date'])
+        stem, digest, fmt = filename.split('.')
     except ValueError:
-        flash("レースの日時情報に誤りがあります")
-        return redirect('/', current_path=request.path)
-    is_closed = now >= voting_deadline
-    if request.method == 'POST':
-        honmeiba = request.form.get('honmeiba')
-        if honmeiba:
-            cursor.execute("""
-                INSERT INTO raise_horse(race_id, username, honmeiba)
-                VALUES(?,?,?)
-                ON CONFLICT(race_id, username) DO UPDATE SET honmeiba=excluded.honmeiba
-            """, (race_id, current_user.username, honmeiba))
-            backup_on_post()
-            conn.commit()
-    if now < cutoff_time:
-        entries = fetch_entries_from_sheet(race_id)
-        print("📄 出馬表（確定前）: Google Sheets から取得")
+        abort(404)
+    name = stem + '.png'
+    if name not in images.IMAGE_VARIANTS or images.source_hash(user_id, name) != digest:
+        # 古いハッシュのURLは、作成済みのファイルが残っていればそのまま返す
+        path = os.path.join(images.IMAGE_BUILD_DIR, 'user', str(user_id), filename)
+        if not os.path.isfile(path):
+            abort(404)
+    else:
+        path = images.build_variant(user_id, name, fmt)
+        if path is None:
+            abort(404)
+    response = send_file(path, mimetype=images.IMAGE_MIMETYPES.get(fmt), max_age=IMMUTABLE_MAX_AGE)
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
+
+def face_image_url(user_id, fmt='png'):
+    return user_image_url(user_id, 'face.png', fmt)
+
+def build_race_view(conn, race_id, is_finalized):
+    cursor = conn.cursor()
+    if not is_finalized:
+        entries = fetch_entries_before(race_id)
+        print("📄 出馬表（確定前）: データベースから取得")
     else:
         cursor.execute("SELECT horse_name FROM race_entries WHERE race_id = ?", (race_id,))
-        rows = cursor.fetchall()
-        entries = [{"horse_name":row["horse_name"], "jockey": ""} for row in rows]
+        entries = [{"horse_name": row["horse_name"], "jockey": ""} for row in cursor.fetchall()]
         print("📄 出馬表（確定後）: データベースから取得")
+
+    # 投票者の一覧と得点順位を1回の読み込みで作る
     cursor.execute("""
-        SELECT rh.username, rh.honmeiba, u.id AS user_id
+        SELECT rh.username, rh.honmeiba, rh.score, u.id AS user_id
         FROM raise_horse rh
-        JOIN users u ON rh.username = u.username
+        LEFT JOIN users u ON rh.username = u.username
         WHERE rh.race_id = ?
     """, (race_id,))
     votes = cursor.fetchall()
     vote_map = {}
-    user_map = {}
-    horse = None
     for row in votes:
-        uname = row['username']
-        horse = row['honmeiba']
-        uid = row['user_id']
-        user_map[uname] = uid
-        if horse not in vote_map:
-            vote_map[horse] = []
-        vote_map[horse].append(uname)
+        if row['user_id'] is None:
+            continue
+        vote_map.setdefault(row['honmeiba'], []).append({
+            "username": row['username'],
+            "image_url": face_image_url(row['user_id']),
+            "image_webp_url": face_image_url(row['user_id'], 'webp')
+        })
     for entry in entries:
-        horse = entry["horse_name"]
-        entry["voted_by"] = [
-            {
-                "username": uname,
-                "image_url": f"https://raw.githubusercontent.com/mayo2451/miyakeiba/main/01miyakeiba%20-%20v1.1/Miyakeiba_app/image/user/{ user_map.get(uname) }/face.png"
-            }
-            for uname in vote_map.get(horse, [])
-        ]
-    is_finalized = now >= cutoff_time
+        entry["voted_by"] = vote_map.get(entry["horse_name"], [])
 
-    cur.execute("SELECT horse_name FROM race_entries WHERE race_id = ?", (race_id,))
-    horses = [row['horse_name'] for row in cur.fetchall()]
-    cur.execute("SELECT * FROM race_result WHERE race_id = ?", (race_id,))
-    result_row = cur.fetchone()
-    result = dict(result_row) if result_row else {
-        'first_place': '', 'second_place': '', 'third_place': '', 'fourth_place': '', 'fifth_place': '',
-        'odds_first': '', 'odds_second': '', 'odds_third': ''
-    }
-    first_place_score = 0
-    second_place_score = 0
-    third_place_score = 0
-    if result.get('first_place') and result.get('odds_first'):
-        try:
-            first_place_score = round(float(result['odds_first']) * 10)
-        except (ValueError, TypeError):
-            logging.error(f"オッズ(1着)の形式が不正です: {result['odds_first']}")
-            first_place_score = 0
-    if result.get('second_place') and result.get('odds_second'):
-        try:
-            second_place_score = round(float(result['odds_second']) * 3)
-        except (ValueError, TypeError):
-            logging.error(f"オッズ(2着)の形式が不正です: {result['odds_second']}")
-            second_place_score = 0
-    if result.get('third_place') and result.get('odds_third'):
-        try:
-            third_place_score = round(float(result['odds_third']) * 1)
-        except (ValueError, TypeError):
-            logging.error(f"オッズ(3着)の形式が不正です: {result['odds_third']}")
-            third_place_score = 0
-            
-    if is_finalized and result.get('first_place'):
-        cur.execute("SELECT username, honmeiba FROM raise_horse WHERE race_id = ?", (race_id,))
-        user_predictions = cur.fetchall()
-
-        for prediction in user_predictions:
-            username = prediction['username']
-            predicted_horse = prediction['honmeiba']
-            score = 0
-
-            if predicted_horse == result['first_place']:
-                score = first_place_score
-            elif predicted_horse == result['second_place']:
-                score = second_place_score
-            elif predicted_horse == result['third_place']:
-                score = third_place_score
-
-            cur.execute("""
-                UPDATE raise_horse
-                SET score = ?
-                WHERE race_id = ? AND username = ?
-            """, (score, race_id, username))
-        conn.commit()
-
-    cur.execute("SELECT race_name FROM race_schedule WHERE id = ?", (race_id,))
-    race_info = cur.fetchone()
-    cur.execute("""SELECT username, honmeiba, score FROM raise_horse WHERE race_id = ?""", (race_id,))
-    scores = cur.fetchall()
-    sorted_scores = sorted(scores, key=lambda x: x['score'], reverse=True)
     ranked_scores = []
     prev_score = None
     rank = 0
-    count = 0
-    for row in sorted_scores:
-        count += 1
+    for count, row in enumerate(sorted(votes, key=lambda x: x['score'], reverse=True), start=1):
         if row['score'] != prev_score:
             rank = count
         ranked_scores.append({
@@ -1249,92 +2194,148 @@ def show_race_page(race_id):
             'score' : row['score']
         })
         prev_score = row['score']
-    cur.execute("""
-        SELECT rh.username, rh.honmeiba, u.id AS user_id
-        FROM raise_horse rh
-        JOIN users u ON rh.username = u.username
-        WHERE rh.race_id = ?
-    """, (race_id,))
-    votes_result = cur.fetchall()
-    vote_map_result = {}
-    for row in votes_result:
-        uname = row['username']
-        horse = row['honmeiba']
-        uid = row['user_id']
-        if horse not in vote_map_result:
-            vote_map_result[horse] = []
-        vote_map_result[horse].append({
-            "username": uname,
-            "image_url": f"https://raw.githubusercontent.com/mayo2451/miyakeiba/main/01miyakeiba%20-%20v1.1/Miyakeiba_app/image/user/{uid}/face.png"
-        })
+
+    cursor.execute("SELECT * FROM race_result WHERE race_id = ?", (race_id,))
+    result_row = cursor.fetchone()
+    result = dict(result_row) if result_row else {
+        'first_place': '', 'second_place': '', 'third_place': '', 'fourth_place': '', 'fifth_place': '',
+        'odds_first': '', 'odds_second': '', 'odds_third': ''
+    }
+    first_place_score = place_score(result['odds_first'], 1) if result.get('first_place') else 0
+    second_place_score = place_score(result['odds_second'], 2) if result.get('second_place') else 0
+    third_place_score = place_score(result['odds_third'], 3) if result.get('third_place') else 0
     if result.get('first_place'):
-        result['voted_by_first'] = vote_map_result.get(result['first_place'], [])
+        result['voted_by_first'] = vote_map.get(result['first_place'], [])
     if result.get('second_place'):
-        result['voted_by_second'] = vote_map_result.get(result['second_place'], [])
+        result['voted_by_second'] = vote_map.get(result['second_place'], [])
     if result.get('third_place'):
-        result['voted_by_third'] = vote_map_result.get(result['third_place'], [])
+        result['voted_by_third'] = vote_map.get(result['third_place'], [])
+
+    return {
+        'entries': entries,
+        'result': result,
+        'first_place_score': first_place_score,
+        'second_place_score': second_place_score,
+        'third_place_score': third_place_score,
+        'scores': ranked_scores,
+    }
+
+def get_race_view(conn, race_id, version, is_finalized):
+    key = (race_id, is_finalized)
+    with race_view_cache_lock:
+        cached = race_view_cache.get(key)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    view = build_race_view(conn, race_id, is_finalized)
+    with race_view_cache_lock:
+        race_view_cache.pop(key, None)
+        if len(race_view_cache) >= RACE_VIEW_CACHE_SIZE:
+            race_view_cache.pop(next(iter(race_view_cache)))
+        race_view_cache[key] = (version, view)
+    return view
+
+@app.route('/race/<int:race_id>', methods=['GET', 'POST'])
+def show_race_page(race_id):
+    conn = connect_db()
+    cursor = conn.cursor()
+
+    cursor.execute("""
+        SELECT rs.id, rs.race_date, rs.race_place, rs.race_name, rs.start_time,
+               COALESCE(dv.version, 0) AS version
+        FROM race_schedule rs
+        LEFT JOIN data_versions dv ON dv.name = 'race:' || rs.id
+        WHERE rs.id = ?
+    """, (race_id,))
+    race = cursor.fetchone()
+    if not race:
+        conn.close()
+        flash("指定されたレースが見つかりません")
+        return redirect('/')
+    race = dict(race)
+    version = race.pop('version')
+    now = datetime.now(JST)
+    try:
+        race_datetime_str = f"{race['race_date']} {race['start_time']}"
+        race_datetime = JST.localize(datetime.strptime(race_datetime_str, "%Y-%m-%d %H:%M"))
+        voting_deadline = race_datetime - timedelta(minutes=1)
+        cutoff_time = get_friday_midnight(race['race_date'])
+    except ValueError:
+        conn.close()
+        flash("レースの日時情報に誤りがあります")
+        return redirect('/')
+    is_closed = now >= voting_deadline
+    is_finalized = now >= cutoff_time
+    etag = page_etag(version, tuple(race.values()), is_closed, is_finalized)
+    cached = not_modified(etag)
+    if cached:
+        conn.close()
+        return cached
+    if request.method == 'POST':
+        honmeiba = request.form.get('honmeiba')
+        if honmeiba:
+            apply_leaderboard_delta(conn, [race_id], -1)
+            cursor.execute("""
+                INSERT INTO raise_horse(race_id, username, honmeiba)
+                VALUES(?,?,?)
+                ON CONFLICT(race_id, username) DO UPDATE SET honmeiba=excluded.honmeiba
+            """, (race_id, current_user.username, honmeiba))
+            apply_leaderboard_delta(conn, [race_id], 1)
+            # 結果が入った後の投票は、その場で採点する（結果がなければ何もしない）
+            rescore(conn, [race_id])
+            conn.commit()
+            backup_on_post()
+            # 投票で版数が上がるので、続く読み込みでは作り直される
+            cursor.execute(
+                "SELECT version FROM data_versions WHERE name = ?", ('race:' + str(race_id),)
+            )
+            version = cursor.fetchone()['version']
+    view = get_race_view(conn, race_id, version, is_finalized)
 
-    #video_url = get_video_url(race_id)
-    video_url = "https://www.youtube.com/watch?v=R9R63qB3j8k" # ★テスト用★
-    logging.info(f"取得した動画URL: {video_url}")  # ★追加★
-    video_id = None
-    if video_url:
-        video_id = extract_youtube_id(video_url)
-    logging.info(f"抽出した動画ID: {video_id}")  # ★追加★
+    video_id = get_video_id(race_id)
 
     conn.close()
 
     view_mode = request.args.get('view', 'entries')
 
-    return render_template('race.html',
+    return etag_response(render_template('race.html',
                            race_id=race_id,
-                           entries=entries,
+                           entries=view['entries'],
                            race=race,
                            selected_race_id=race_id,
                            is_closed=is_closed,
                            is_finalized=is_finalized,
-                           horse=horse,
-                           result=result,
-                           first_place_score=first_place_score,
-                           second_place_score=second_place_score,
-                           third_place_score=third_place_score,
-                           scores=ranked_scores,
+                           result=view['result'],
+                           first_place_score=view['first_place_score'],
+                           second_place_score=view['second_place_score'],
+                           third_place_score=view['third_place_score'],
+                           scores=view['scores'],
                            video_id=video_id,
-                           view=view_mode
-                          )
+                           view=view_mode,
+                           race_version=version
+                          ), etag)
 
 @app.route('/allusers')
 def allusers():
     conn = connect_db()
+    etag = page_etag(read_data_versions(conn, ('schedule', 'leaderboard')))
+    cached = not_modified(etag)
+    if cached:
+        conn.close()
+        return cached
     cur = conn.cursor()
 
     cur.execute("SELECT DISTINCT race_grade FROM race_schedule ORDER BY race_grade")
-    grades = [row[0] for row in cur.fetchall() if row[0] not in ('race_grade',)]
+    grades = [row[0] for row in cur.fetchall()]
     
     cur.execute("SELECT DISTINCT race_place FROM race_schedule ORDER BY race_place")
-    places = [row[0] for row in cur.fetchall() if row[0] not in ('race_place',)]
+    places = [row[0] for row in cur.fetchall()]
 
-    cur.execute("""
-        SELECT
-            username,
-            COUNT(*) AS total_races,
-            SUM(score) AS total_score,
-            SUM(CASE WHEN honmeiba_rank = 1 THEN 1 ELSE 0 END) AS first,
-            SUM(CASE WHEN honmeiba_rank = 2 THEN 1 ELSE 0 END) AS second,
-            SUM(CASE WHEN honmeiba_rank = 3 THEN 1 ELSE 0 END) AS third,
-            SUM(CASE WHEN honmeiba_rank BETWEEN 4 AND 5 THEN 1 ELSE 0 END) AS bbs,
-            SUM(CASE WHEN honmeiba_rank = 0 THEN 1 ELSE 0 END) AS out_of_place,
-            ROUND(AVG(CASE WHEN honmeiba_rank = 1 THEN 1.00 ELSE 0 END), 4) AS win_rate,
-            ROUND(AVG(CASE WHEN honmeiba_rank BETWEEN 1 AND 3 THEN 1.00 ELSE 0 END), 4) AS placing_bets_rate
-        FROM raise_horse rh
-        JOIN race_schedule rs ON rh.race_id = rs.id
-        WHERE rh.race_id NOT IN (24,25,26,27,28,29,30,31,32,33,34,35,36,37,38)
-        GROUP BY username
-        ORDER BY total_score DESC
-    """)
-    users = cur.fetchall()
+    # 最初の1ページだけ描画し、続きと並べ替えは /api/leaderboard から読む
+    all_total, users = get_leaderboard_page(conn)
     conn.close()
-    return render_template('alluserscore.html', all_users=users, grades=grades, places=places)
+    return etag_response(render_template('alluserscore.html', all_users=users, all_total=all_total,
+                                         grades=grades, places=places), etag)
 
 @app.route('/filtered_users')
 def filtered_users():
@@ -1342,66 +2343,26 @@ def filtered_users():
     venue = request.args.get('venue')      # e.g., 東京
 
     conn = connect_db()
+    etag = page_etag(read_data_versions(conn, ('schedule', 'leaderboard')))
+    cached = not_modified(etag)
+    if cached:
+        conn.close()
+        return cached
     cur = conn.cursor()
 
     cur.execute("SELECT DISTINCT race_grade FROM race_schedule ORDER BY race_grade")
-    grades = [row[0] for row in cur.fetchall() if row[0] not in ('race_grade',)]
+    grades = [row[0] for row in cur.fetchall()]
     
     cur.execute("SELECT DISTINCT race_place FROM race_schedule ORDER BY race_place")
-    places = [row[0] for row in cur.fetchall() if row[0] not in ('race_place',)]
-
-    all_query = """
-        SELECT
-            username,
-            COUNT(*) AS total_races,
-            SUM(score) AS total_score,
-            SUM(CASE WHEN honmeiba_rank = 1 THEN 1 ELSE 0 END) AS first,
-            SUM(CASE WHEN honmeiba_rank = 2 THEN 1 ELSE 0 END) AS second,
-            SUM(CASE WHEN honmeiba_rank = 3 THEN 1 ELSE 0 END) AS third,
-            SUM(CASE WHEN honmeiba_rank BETWEEN 4 AND 5 THEN 1 ELSE 0 END) AS bbs,
-            SUM(CASE WHEN honmeiba_rank = 0 THEN 1 ELSE 0 END) AS out_of_place,
-            ROUND(AVG(CASE WHEN honmeiba_rank = 1 THEN 1.00 ELSE 0 END), 4) AS win_rate,
-            ROUND(AVG(CASE WHEN honmeiba_rank BETWEEN 1 AND 3 THEN 1.00 ELSE 0 END), 4) AS placing_bets_rate
-        FROM raise_horse rh
-        JOIN race_schedule rs ON rh.race_id = rs.id
-        GROUP BY username
-        ORDER BY total_score DESC
-    """
-    cur.execute(all_query)
-    all_users = cur.fetchall()
+    places = [row[0] for row in cur.fetchall()]
 
-    filtered_query = """
-        SELECT
-            username,
-            COUNT(*) AS total_races,
-            SUM(score) AS total_score,
-            SUM(CASE WHEN honmeiba_rank = 1 THEN 1 ELSE 0 END) AS first,
-            SUM(CASE WHEN honmeiba_rank = 2 THEN 1 ELSE 0 END) AS second,
-            SUM(CASE WHEN honmeiba_rank = 3 THEN 1 ELSE 0 END) AS third,
-            SUM(CASE WHEN honmeiba_rank BETWEEN 4 AND 5 THEN 1 ELSE 0 END) AS bbs,
-            SUM(CASE WHEN honmeiba_rank = 0 THEN 1 ELSE 0 END) AS out_of_place,
-            ROUND(AVG(CASE WHEN honmeiba_rank = 1 THEN 1.00 ELSE 0 END), 4) AS win_rate,
-            ROUND(AVG(CASE WHEN honmeiba_rank BETWEEN 1 AND 3 THEN 1.00 ELSE 0 END), 4) AS placing_bets_rate
-        FROM raise_horse rh
-        JOIN race_schedule rs ON rh.race_id = rs.id
-        WHERE rh.race_id NOT IN (24,25,26,27,28,29,30,31,32,33,34,35,36,37,38)
-        WHERE 1=1
-    """
-    params = []
-    if grade:
-        filtered_query += " AND rs.race_grade = ?"
-        params.append(grade)
-    if venue:
-        filtered_query += " AND rs.race_place = ?"
-        params.append(venue)
-
-    filtered_query += " GROUP BY username ORDER BY total_score DESC"
-
-    cur.execute(filtered_query, params)
-    filtered_users = cur.fetchall()
+    all_total, all_users = get_leaderboard_page(conn)
+    filtered_total, filtered_users = get_leaderboard_page(conn, grade=grade, place=venue)
     conn.close()
 
-    return render_template('alluserscore.html', all_users=all_users, filtered_users=filtered_users, grades=grades, places=places)
+    return etag_response(render_template('alluserscore.html', all_users=all_users, all_total=all_total,
+                                         filtered_users=filtered_users, filtered_total=filtered_total,
+                                         grade=grade or '', venue=venue or '', grades=grades, places=places), etag)
 
 @app.route('/schedule')
 def schedule():
@@ -1410,34 +2371,26 @@ def schedule():
     year_today = today.year
     month_today = today.month
     
-    # get_events_for_monthはリストを返すため、辞書に変換
-    this_month_events_list = get_events_for_month(year_today, month_today)
-    this_month_events_dict = {}
-    for event in this_month_events_list:
-        date_key = event['race_date_display']
-        if date_key not in this_month_events_dict:
-            this_month_events_dict[date_key] = []
-        this_month_events_dict[date_key].append(event)
-
-    races = get_this_week_races()
     cal_year = request.args.get('year', default=year_today, type=int)
     cal_month = request.args.get('month', default=month_today, type=int)
-    
-    # get_events_for_monthはリストを返すため、辞書に変換
-    calendar_events_list = get_events_for_month(cal_year, cal_month)
-    calendar_events_dict = {}
-    for event in calendar_events_list:
-        date_key = event['race_date_display']
-        if date_key not in calendar_events_dict:
-            calendar_events_dict[date_key] = []
-        calendar_events_dict[date_key].append(event)
-
-    cal = HolidayCalendar(firstweekday=0)
-    calendar_html = cal.formatmonth(cal_year, cal_month)
-    
-    # 辞書のキー（日付）でソート
-    this_month_events_sorted = sorted(this_month_events_dict.items(), key=lambda x: x[0])
-    calendar_events_sorted = sorted(calendar_events_dict.items(), key=lambda x: x[0])
+
+    conn = connect_db()
+    schedule_version, = read_data_versions(conn, ('schedule',))
+    etag = page_etag((schedule_version,), today)
+    conn.close()
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
+    # 今月・表示中の月・今週にかかる月を1回で読み込む（同じ月は1度だけ）
+    month_events = load_month_events(
+        [(year_today, month_today), (cal_year, cal_month)] + week_months(today)
+    )
+    this_month_events_sorted = group_events_by_date(month_events[(year_today, month_today)])
+    calendar_events_sorted = group_events_by_date(month_events[(cal_year, cal_month)])
+    races = get_this_week_races(today, month_events)
+
+    calendar_html = render_calendar(cal_year, cal_month, today)
 
     prev_month = cal_month - 1
     prev_year = cal_year
@@ -1451,7 +2404,7 @@ def schedule():
         next_month = 1
         next_year += 1
 
-    return render_template(
+    return etag_response(render_template(
         'schedule.html',
         races = races,
         this_month_events = this_month_events_sorted,
@@ -1462,8 +2415,15 @@ def schedule():
         prev_year = prev_year,
         prev_month = prev_month,
         next_year = next_year,
-        next_month = next_month
-    )
+        next_month = next_month,
+        today = today,
+        schedule_version = schedule_version
+    ), etag)
+
+# 起動時のDB準備（全関数の定義後に1回だけ）
+boot_database()
+asset_manifest.update(assets.build_all())
+startup_backup_check()
 
 if __name__ == '__main__':
     app.run(debug=False)
@@ -0,0 +1,95 @@
+"""
+static/ の CSS と JS をページごとに1ファイルへまとめ、内容ハッシュ入りの名前で
+static/build/ に書き出すモジュール。gzip（と brotli が入っていれば br）で圧縮した版も一緒に作り、
+app.py はブラウザが受け取れる圧縮版をそのまま返します。
+
+app.py は起動時に足りないものだけを作りますが、デプロイ時にまとめて作っておくこともできます。
+
+    python assets.py
+"""
+import gzip
+import hashlib
+import json
+import os
+import time
+
+try:
+    import brotli # type: ignore
+except ImportError:  # brotli がなければ gzip 版だけを作る
+    brotli = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(BASE_DIR, 'static')
+ASSET_BUILD_DIR = os.path.join(STATIC_DIR, 'build')
+MANIFEST_PATH = os.path.join(ASSET_BUILD_DIR, 'manifest.json')
+
+# まとめたファイル名 -> 元ファイル（static/ からの相対パス）。CSS は各ページで読み込んでいた順に並べる
+ASSET_BUNDLES = {
+    'home.css': ['homestyle.css', 'ThisWeekRace.css'],
+    'schedule.css': ['calendar.css', 'homestyle.css', 'ThisWeekRace.css'],
+    'main.css': ['alluserscore.css', 'calendar.css', 'homestyle.css'],
+    'alluserscore.css': ['alluserscore.css', 'homestyle.css'],
+    'race.css': ['homestyle.css', 'resulttable.css', 'entryhorsetable.css', 'race_video.css'],
+    'entry_form.css': ['entryhorsetable.css', 'homestyle.css'],
+    'insert_race.css': ['homestyle.css', 'insertstyle.css'],
+    'insert_result.css': ['homestyle.css'],
+    'mypage.css': ['homestyle.css', 'mypagestyle.css'],
+    'alluserscore.js': ['js/alluserscore.js'],
+    'this_week_race.js': ['js/this_week_race.js'],
+    'waku_color.js': ['js/waku_color.js'],
+}
+ASSET_MIMETYPES = {'.css': 'text/css', '.js': 'text/javascript'}
+# Content-Encoding -> 圧縮版の拡張子
+ASSET_ENCODINGS = {'br': '.br', 'gzip': '.gz'}
+
+def bundle_content(sources):
+    parts = []
+    for source in sources:
+        with open(os.path.join(STATIC_DIR, source), 'rb') as f:
+            content = f.read()
+        # 1ファイルにまとめても元の場所が分かるように、ファイル名を残しておく
+        parts.append(b'/* ' + source.encode() + b' */\n' + content.rstrip() + b'\n')
+    return b'\n'.join(parts)
+
+def write_file(path, content):
+    if os.path.exists(path):
+        return
+    # 複数のワーカーが同時に起動しても書きかけのファイルを配らないよう、一時ファイルから置き換える
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+def build_bundle(name, sources):
+    """1つのバンドルと圧縮版を書き出し、ハッシュ入りのファイル名を返す。"""
+    content = bundle_content(sources)
+    stem, ext = os.path.splitext(name)
+    filename = f"{stem}.{hashlib.sha256(content).hexdigest()[:12]}{ext}"
+    path = os.path.join(ASSET_BUILD_DIR, filename)
+    write_file(path, content)
+    # mtime=0 にして、同じ内容なら何度作っても同じ .gz になるようにする
+    write_file(path + ASSET_ENCODINGS['gzip'], gzip.compress(content, compresslevel=9, mtime=0))
+    if brotli:
+        write_file(path + ASSET_ENCODINGS['br'], brotli.compress(content))
+    return filename
+
+def build_all():
+    """すべてのバンドルを作り、{バンドル名: ハッシュ入りのファイル名} を manifest.json に書いて返す。"""
+    os.makedirs(ASSET_BUILD_DIR, exist_ok=True)
+    manifest = {name: build_bundle(name, sources) for name, sources in ASSET_BUNDLES.items()}
+    tmp_path = f"{MANIFEST_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, MANIFEST_PATH)
+    return manifest
+
+def encodings():
+    return [encoding for encoding in ASSET_ENCODINGS if encoding != 'br' or brotli]
+
+def main():
+    start = time.monotonic()
+    manifest = build_all()
+    print(f"📦 {len(manifest)}個のバンドルを作りました（{'・'.join(encodings())}、{time.monotonic() - start:.2f}秒） → {ASSET_BUILD_DIR}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+テンプレートの一部分を、描画済みの HTML のままプロセス内に保持する {% cache %} タグ。
+app.py で Jinja に登録しているので、どのテンプレート・マクロからでも使えます。
+
+    {% cache 'race-entries', race_id, race_version, is_closed %}
+        ... 出馬表 ...
+    {% endcache %}
+
+キーには、その部分の表示に使うデータの版数（data_versions）や日付を必ず含めてください。
+版数が上がれば別のキーになり、古い HTML は使われないまま LRU で追い出されます。
+ログインユーザーで変わる部分（メニューや管理者用のボタンなど）はブロックの外に書きます。
+"""
+import os
+import sys
+import threading
+
+from jinja2 import nodes # type: ignore
+from jinja2.ext import Extension # type: ignore
+
+# 保持する HTML の合計の上限（バイト）。超えたら使われていない順に捨てる
+FRAGMENT_CACHE_MAX_BYTES = int(os.getenv("FRAGMENT_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))
+
+# キー -> (HTML, サイズ)。dict の並びを使われた順にして、先頭から追い出す
+fragments = {}
+fragments_lock = threading.Lock()
+fragments_size = 0
+
+def get_fragment(key):
+    with fragments_lock:
+        item = fragments.pop(key, None)
+        if item is None:
+            return None
+        fragments[key] = item
+        return item[0]
+
+def put_fragment(key, html):
+    global fragments_size
+    size = sys.getsizeof(html)
+    if size > FRAGMENT_CACHE_MAX_BYTES:
+        return
+    with fragments_lock:
+        old = fragments.pop(key, None)
+        if old:
+            fragments_size -= old[1]
+        while fragments and fragments_size + size > FRAGMENT_CACHE_MAX_BYTES:
+            fragments_size -= fragments.pop(next(iter(fragments)))[1]
+        fragments[key] = (html, size)
+        fragments_size += size
+
+def clear_fragments():
+    global fragments_size
+    with fragments_lock:
+        fragments.clear()
+        fragments_size = 0
+
+class FragmentCacheExtension(Extension):
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        # {% cache 名前, 版数, ... %} のカンマ区切りをそのままキーにする
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        return nodes.CallBlock(
+            self.call_method('_render_fragment', [nodes.Tuple(args, 'load')]), [], [], body
+        ).set_lineno(lineno)
+
+    def _render_fragment(self, key, caller):
+        html = get_fragment(key)
+        if html is None:
+            html = caller()
+            put_fragment(key, html)
+        return html
@@ -0,0 +1,128 @@
+"""
+ユーザー画像（image/user/<id>/ の顔写真・順位アイコン）を表示サイズに縮小し、
+PNG と WebP の2形式で image/build/ に書き出すモジュール。
+書き出すファイル名には元画像の内容ハッシュが入るので、画像を差し替えるとURLも変わり、
+ブラウザには長期間キャッシュさせられます。
+
+app.py は最初に要求された時にその場で作りますが、デプロイ時にまとめて作っておくこともできます。
+
+    python images.py             # 全ユーザー分を作る
+    python images.py 1 10 12     # 指定したユーザーだけ
+"""
+import argparse
+import hashlib
+import os
+import threading
+import time
+
+try:
+    from PIL import Image # type: ignore
+except ImportError:  # Pillow がなければ縮小せず、元の PNG をそのまま配る
+    Image = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+USER_IMAGE_DIR = os.path.join(BASE_DIR, 'image', 'user')
+IMAGE_BUILD_DIR = os.getenv("IMAGE_BUILD_DIR", os.path.join(BASE_DIR, 'image', 'build'))
+
+# 元画像ごとの書き出し高さ(px)。表示サイズの2倍にして高解像度の画面でもぼやけないようにする
+#   face.png       … 出馬表・結果の投票者（.face は高さ30px）
+#   1st-icon.png   … トップページの1位（高さ250px）
+#   2-3th-icon.png … トップページの2・3位（高さ120px）
+IMAGE_VARIANTS = {
+    'face.png': 60,
+    '1st-icon.png': 500,
+    '2-3th-icon.png': 240,
+}
+IMAGE_FORMATS = {
+    'png': {'format': 'PNG', 'optimize': True},
+    'webp': {'format': 'WEBP', 'quality': 82, 'method': 6},
+}
+IMAGE_MIMETYPES = {'png': 'image/png', 'webp': 'image/webp'}
+
+# 元画像のパス -> (更新時刻, サイズ, ハッシュ)。ファイルが変わった時だけ読み直す
+source_hashes = {}
+source_hashes_lock = threading.Lock()
+build_lock = threading.Lock()
+
+def source_path(user_id, name):
+    return os.path.join(USER_IMAGE_DIR, str(int(user_id)), name)
+
+def source_hash(user_id, name):
+    """元画像の内容と書き出し高さから作る短いハッシュ。元画像がなければ None。"""
+    path = source_path(user_id, name)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    with source_hashes_lock:
+        cached = source_hashes.get(path)
+    if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+
+    digest = hashlib.sha256(str(IMAGE_VARIANTS[name]).encode())
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    value = digest.hexdigest()[:12]
+    with source_hashes_lock:
+        source_hashes[path] = (stat.st_mtime_ns, stat.st_size, value)
+    return value
+
+def variant_filename(name, digest, fmt):
+    # face.png -> face.<hash>.webp
+    return f"{os.path.splitext(name)[0]}.{digest}.{fmt}"
+
+def image_formats():
+    return list(IMAGE_FORMATS) if Image else ['png']
+
+def build_variant(user_id, name, fmt):
+    """縮小した画像を書き出してそのパスを返す。作成済みならそのまま返す。元画像がなければ None。"""
+    digest = source_hash(user_id, name)
+    if digest is None or fmt not in image_formats():
+        return None
+    if Image is None:
+        return source_path(user_id, name)
+    path = os.path.join(IMAGE_BUILD_DIR, 'user', str(int(user_id)), variant_filename(name, digest, fmt))
+    if os.path.exists(path):
+        return path
+
+    with build_lock:
+        if os.path.exists(path):
+            return path
+        with Image.open(source_path(user_id, name)) as image:
+            image = image.convert('RGBA')
+            height = IMAGE_VARIANTS[name]
+            if image.height > height:
+                width = max(1, round(image.width * height / image.height))
+                image = image.resize((width, height), Image.LANCZOS)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 書きかけのファイルを配信しないよう、一時ファイルに書いてから置き換える
+            tmp_path = path + '.tmp'
+            image.save(tmp_path, **IMAGE_FORMATS[fmt])
+            os.replace(tmp_path, path)
+    return path
+
+def user_ids():
+    return sorted(int(d) for d in os.listdir(USER_IMAGE_DIR) if d.isdigit())
+
+def build_all(ids=None):
+    """指定ユーザー（省略時は全員）のすべての縮小画像を作る。作った（または既にあった）枚数を返す。"""
+    count = 0
+    for user_id in ids or user_ids():
+        for name in IMAGE_VARIANTS:
+            for fmt in image_formats():
+                if build_variant(user_id, name, fmt):
+                    count += 1
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(description="ユーザー画像の縮小版（PNG・WebP）を作ります")
+    parser.add_argument('user_ids', nargs='*', type=int, help="作るユーザーID（省略時は全員）")
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    count = build_all(args.user_ids)
+    print(f"🖼️ {count}枚の画像を用意しました（{time.monotonic() - start:.1f}秒） → {IMAGE_BUILD_DIR}")
+
+if __name__ == '__main__':
+    main()
@@ -1,29 +1,182 @@
-import sqlite3
+"""
+開催日程のCSVを race_schedule に取り込みます。
+
+    python import_csv.py                          # race_schedule.csv を取り込む
+    python import_csv.py jra_2020_2025.csv --db miyakeiba_app.db
+
+(race_date, race_place, race_number) が同じレースは更新、なければ追加します。
+CSVは1行ずつ読みながら CHUNK_SIZE 行ごとに書き込み、全体を1つのトランザクションで行うので、
+途中でエラーになった時は何も変わりません。
+"""
+import argparse
 import csv
+import itertools
+import re
+import sqlite3
+import time
+
+from scoring import apply_leaderboard_delta
+
+# SQLiteデータベースとCSVファイルのパス（引数で変更できます）
+DB_NAME = 'miyakeiba_app.db'
+CSV_FILE_PATH = 'race_schedule.csv'
+# 何行ずつ executemany にまとめるか
+CHUNK_SIZE = 1000
 
-# SQLiteデータベースへの接続
-conn = sqlite3.connect('miyakeiba_app.db')
-cursor = conn.cursor()
+KEY_COLUMNS = ['race_date', 'race_place', 'race_number']
+COLUMNS = KEY_COLUMNS + ['race_grade', 'race_name', 'start_time', 'race_ground', 'race_distance']
+# 見出し行がないCSVは、以前の取り込みと同じ並び順とみなす
+DEFAULT_HEADER = ['race_date', 'race_place', 'race_number', 'race_grade', 'race_name', 'start_time']
+INTEGER_COLUMNS = {'race_number', 'race_distance'}
+DATE_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}$')
 
-# CSVファイルのパス（適宜変更）
-csv_file_path = 'race_schedule.csv'
+def parse_row(header, row, line_number):
+    """1行を検証して値のタプルにします。不正な行は理由を表示して None を返します。"""
+    if len(row) != len(header):
+        print(f"⚠️ {line_number}行目: 列数が見出しと一致しません。スキップします。")
+        return None
+    record = {}
+    for name, value in zip(header, row):
+        value = value.strip()
+        if name in INTEGER_COLUMNS:
+            if value == '':
+                value = None
+            elif value.isdigit():
+                value = int(value)
+            else:
+                print(f"⚠️ {line_number}行目: {name} が数値ではありません（{value}）。スキップします。")
+                return None
+        record[name] = value
+    if not DATE_PATTERN.match(record['race_date']):
+        print(f"⚠️ {line_number}行目: race_date の形式が不正です（{record['race_date']}）。スキップします。")
+        return None
+    if not record['race_place'] or record['race_number'] is None:
+        print(f"⚠️ {line_number}行目: race_place / race_number が空です。スキップします。")
+        return None
+    return tuple(record[name] for name in header)
 
-# CSVを開いて1行ずつ読み込み、INSERTする
-with open(csv_file_path, newline='', encoding='utf-8') as csvfile:
+def import_schedule(conn, csvfile, chunk_size=CHUNK_SIZE):
+    """
+    CSVを一時テーブルに流し込み、そこから race_schedule へまとめて更新・追加します。
+    CSVにない列（race_ground など）は、既存のレースでは書き換えません。
+    戻り値は (読み込んだ行数, 追加, 更新, スキップ) です。
+    """
     reader = csv.reader(csvfile)
+    first = next(reader, None)
+    if first is None:
+        return 0, 0, 0, 0
+    if first and first[0].strip() == 'race_date':
+        header = [name.strip() for name in first]
+        rows, line_number = reader, 2
+    else:
+        header = DEFAULT_HEADER
+        rows, line_number = itertools.chain([first], reader), 1
+
+    unknown = [name for name in header if name not in COLUMNS]
+    if unknown:
+        raise ValueError(f"不明な列があります: {', '.join(unknown)}")
+    missing = [name for name in KEY_COLUMNS if name not in header]
+    if missing:
+        raise ValueError(f"必須の列がありません: {', '.join(missing)}")
+
+    cursor = conn.cursor()
+    # 同じレースがCSVに2回出てきた時は、後の行で上書きする
+    cursor.execute(f"""
+        CREATE TEMP TABLE IF NOT EXISTS import_race_schedule (
+            {', '.join(f'{name} {"INTEGER" if name in INTEGER_COLUMNS else "TEXT"}' for name in COLUMNS)},
+            PRIMARY KEY ({', '.join(KEY_COLUMNS)})
+        )
+    """)
+    cursor.execute("DELETE FROM import_race_schedule")
+
+    total = skipped = 0
+    insert_sql = f"""
+        INSERT OR REPLACE INTO import_race_schedule ({', '.join(header)})
+        VALUES ({', '.join('?' for _ in header)})
+    """
+    chunk = []
+    for row in rows:
+        if any(value.strip() for value in row):
+            total += 1
+            values = parse_row(header, row, line_number)
+            if values is None:
+                skipped += 1
+            else:
+                chunk.append(values)
+            if len(chunk) >= chunk_size:
+                cursor.executemany(insert_sql, chunk)
+                chunk = []
+        line_number += 1
+    if chunk:
+        cursor.executemany(insert_sql, chunk)
+
+    match = " AND ".join(f"rs.{name} = i.{name}" for name in KEY_COLUMNS)
+    value_columns = [name for name in header if name not in KEY_COLUMNS]
+    updated = 0
+    if value_columns:
+        changed = " OR ".join(f"rs.{name} IS NOT i.{name}" for name in value_columns)
+        # グレード・競馬場が変わるレースは集計表の行も変わるので、変更前の分を引いておく
+        cursor.execute(f"""
+            SELECT rs.id FROM race_schedule rs
+            JOIN import_race_schedule i ON {match}
+            WHERE {changed}
+        """)
+        changed_ids = [row[0] for row in cursor.fetchall()]
+        has_leaderboard = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'leaderboard'"
+        ).fetchone()
+        if changed_ids and has_leaderboard:
+            apply_leaderboard_delta(conn, changed_ids, -1)
+        cursor.execute(f"""
+            UPDATE race_schedule AS rs
+            SET {', '.join(f'{name} = i.{name}' for name in value_columns)}
+            FROM import_race_schedule i
+            WHERE {match} AND ({changed})
+        """)
+        updated = cursor.rowcount
+        if changed_ids and has_leaderboard:
+            apply_leaderboard_delta(conn, changed_ids, 1)
+
+    cursor.execute(f"""
+        INSERT INTO race_schedule ({', '.join(header)})
+        SELECT {', '.join(f'i.{name}' for name in header)}
+        FROM import_race_schedule i
+        WHERE NOT EXISTS (SELECT 1 FROM race_schedule rs WHERE {match})
+        ORDER BY i.race_date, i.race_place, i.race_number
+    """)
+    inserted = cursor.rowcount
+    cursor.execute("DELETE FROM import_race_schedule")
+    return total, inserted, updated, skipped
 
-    # ヘッダーをスキップ（ある場合）
-    # next(reader)
+def main():
+    parser = argparse.ArgumentParser(description="開催日程のCSVを race_schedule に取り込みます")
+    parser.add_argument('csv_file', nargs='?', default=CSV_FILE_PATH, help="CSVファイルのパス")
+    parser.add_argument('--db', default=DB_NAME, help="SQLiteデータベースのパス")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help="まとめて書き込む行数")
+    args = parser.parse_args()
 
-    for row in reader:
-        # カラム数と順番に合わせてください
-        cursor.execute("""
-            INSERT INTO race_schedule (race_date, race_place, race_number, race_grade, race_name, start_time)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, row)
+    conn = sqlite3.connect(args.db)
+    started = time.time()
+    try:
+        with open(args.csv_file, newline='', encoding='utf-8-sig') as csvfile:
+            conn.execute("BEGIN")
+            total, inserted, updated, skipped = import_schedule(conn, csvfile, args.chunk_size)
+        # 起動中のアプリに、変更をスプレッドシートへ送ってもらう
+        if (inserted or updated) and conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'backup_jobs'"
+        ).fetchone():
+            conn.execute("INSERT INTO backup_jobs (requested_at, force) VALUES (?, 1)", (time.time(),))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
 
-# コミットして接続終了
-conn.commit()
-conn.close()
+    elapsed = time.time() - started
+    rate = total / elapsed if elapsed > 0 else total
+    print(f"CSVからのインポートが完了しました。{total}行（追加 {inserted} / 更新 {updated} / スキップ {skipped}）"
+          f" {elapsed:.2f}秒、{rate:,.0f}行/秒")
 
-print("CSVからのインポートが完了しました。")
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+"""
+本命馬の採点と、成績集計（users の通算成績・leaderboard）の作り直しをまとめたモジュール。
+app.py の結果入力から1レースずつ呼ぶほか、データを直した後は
+コマンドラインから任意のレース、または全レースをまとめて採点し直せます。
+
+    python scoring.py            # 全レース
+    python scoring.py 12 13 14   # 指定したレースだけ
+
+集計期間の例外（scoring_period_rules）もここから追加・削除できます。
+
+    python scoring.py --rules                    # 一覧
+    python scoring.py --exclude 40               # レース40をすべての期間から外す
+    python scoring.py --include 41 2026-01       # レース41を2026年1月の月間にも加算
+    python scoring.py --delete-rule 7
+"""
+import argparse
+import logging
+import sqlite3
+import time
+
+# 着順ごとの得点倍率（オッズ×倍率を四捨五入）。4・5着は掲示板として数えるだけで得点はなし
+PLACE_MULTIPLIERS = {1: 10, 2: 3, 3: 1}
+PLACE_COLUMNS = ['first_place', 'second_place', 'third_place', 'fourth_place', 'fifth_place']
+ODDS_COLUMNS = {1: 'odds_first', 2: 'odds_second', 3: 'odds_third'}
+
+def place_score(odds, rank):
+    """着順 rank の馬に本命を打った時の得点。オッズが空や不正なら0点。"""
+    multiplier = PLACE_MULTIPLIERS.get(rank)
+    if not multiplier or odds in (None, ''):
+        return 0
+    try:
+        return round(float(odds) * multiplier)
+    except (ValueError, TypeError):
+        logging.error(f"オッズ({rank}着)の形式が不正です: {odds}")
+        return 0
+
+def finishing_table(result):
+    """レース結果1件から {馬名: (着順, オッズ, 得点)} を作る。同じ馬名は上の着順を優先。"""
+    table = {}
+    for rank, column in enumerate(PLACE_COLUMNS, start=1):
+        horse = result[column]
+        if horse in (None, '') or horse in table:
+            continue
+        odds = result[ODDS_COLUMNS[rank]] if rank in ODDS_COLUMNS else None
+        table[horse] = (rank, odds, place_score(odds, rank))
+    return table
+
+def race_filter_sql(column, race_ids):
+    if race_ids is None:
+        return "1", []
+    return f"{column} IN ({', '.join('?' for _ in race_ids)})", list(race_ids)
+
+def setup_period_rules(conn):
+    """
+    集計期間のルール表。レースは通常「通算（'*'）」と「レース日の月（'YYYY-MM'）」に入り、
+      include: period の期間にも加算する（例: 2025-10 の月間に前月のレースを入れる）
+      exclude: period の期間から外す（'all' ならすべての期間から外す）
+    ルールを足すだけで集計が変わるので、例外のたびにSQLを書き足す必要はありません。
+    """
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS scoring_period_rules (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            race_id INTEGER NOT NULL,
+            period TEXT NOT NULL,
+            action TEXT NOT NULL CHECK (action IN ('include', 'exclude')),
+            note TEXT
+        )
+    """)
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_scoring_period_rules_race_id ON scoring_period_rules (race_id, action, period)"
+    )
+    conn.commit()
+
+# 表ができる前からあった例外。初回のマイグレーションでルール表に入れる
+DEFAULT_PERIOD_RULES = [
+    (race_id, 'all', 'exclude', '集計対象外') for race_id in range(24, 39)
+] + [
+    (2, '2025-10', 'include', '2025年10月の月間にも加算'),
+]
+
+def seed_period_rules(conn):
+    # スプレッドシートから復元したルールがある時はそちらを使う
+    if conn.execute("SELECT 1 FROM scoring_period_rules LIMIT 1").fetchone():
+        return
+    conn.executemany(
+        "INSERT INTO scoring_period_rules (race_id, period, action, note) VALUES (?, ?, ?, ?)",
+        DEFAULT_PERIOD_RULES
+    )
+
+def race_periods_sql(race_ids=None):
+    """
+    各レースがどの集計期間（'*' = 通算、'YYYY-MM' = 月間）に入るかを返すSQL。
+    scoring_period_rules を反映済み。race_ids を渡すと :race_0, :race_1 ... で絞り込みます。
+    """
+    def race_filter(column):
+        if race_ids is None:
+            return "1"
+        return f"{column} IN ({', '.join(f':race_{i}' for i in range(len(race_ids)))})"
+
+    return f"""
+        SELECT p.race_id, p.period, p.race_grade, p.race_place
+        FROM (
+            SELECT id AS race_id, '*' AS period, race_grade, race_place
+            FROM race_schedule WHERE {race_filter('id')}
+            UNION
+            SELECT id, substr(race_date, 1, 7), race_grade, race_place
+            FROM race_schedule WHERE {race_filter('id')}
+            UNION
+            SELECT rs.id, r.period, rs.race_grade, rs.race_place
+            FROM scoring_period_rules r
+            JOIN race_schedule rs ON rs.id = r.race_id
+            WHERE r.action = 'include' AND {race_filter('r.race_id')}
+        ) p
+        WHERE NOT EXISTS (
+            SELECT 1 FROM scoring_period_rules x
+            WHERE x.race_id = p.race_id AND x.action = 'exclude' AND x.period IN ('all', p.period)
+        )
+    """
+
+def add_period_rule(conn, race_id, period, action, note=None):
+    """ルールを1件追加し、そのレースの分だけ集計表を付け直す。"""
+    apply_leaderboard_delta(conn, [race_id], -1)
+    cursor = conn.execute(
+        "INSERT INTO scoring_period_rules (race_id, period, action, note) VALUES (?, ?, ?, ?)",
+        (race_id, period, action, note)
+    )
+    apply_leaderboard_delta(conn, [race_id], 1)
+    return cursor.lastrowid
+
+def delete_period_rule(conn, rule_id):
+    row = conn.execute("SELECT race_id FROM scoring_period_rules WHERE id = ?", (rule_id,)).fetchone()
+    if not row:
+        return False
+    apply_leaderboard_delta(conn, [row[0]], -1)
+    conn.execute("DELETE FROM scoring_period_rules WHERE id = ?", (rule_id,))
+    apply_leaderboard_delta(conn, [row[0]], 1)
+    return True
+
+def apply_leaderboard_delta(conn, race_ids, sign):
+    """
+    指定レースの本命馬データを、ユーザー×期間×グレード×競馬場の集計表に足す（sign=1）か引く（sign=-1）。
+    グレード・競馬場は '*'（すべて）の行にも同時に加算するので、どの絞り込みも主キーで読めます。
+    結果や投票を書き換える時は、書き換え前に -1、書き換え後に +1 を同じトランザクションで呼びます。
+    race_ids が None の時は全レースが対象です。
+    """
+    params = {"sign": sign}
+    race_filter = "1"
+    if race_ids is not None:
+        race_filter = "rh.race_id IN ({})".format(', '.join(f":race_{i}" for i in range(len(race_ids))))
+        params.update({f"race_{i}": race_id for i, race_id in enumerate(race_ids)})
+    conn.execute(f"""
+        WITH race_periods AS (
+            {race_periods_sql(race_ids)}
+        ),
+        rollup AS (SELECT 0 AS is_all UNION ALL SELECT 1)
+        INSERT INTO leaderboard (
+            period, race_grade, race_place, username,
+            total_races, total_score, first, second, third, bbs, out_of_place
+        )
+        SELECT
+            rp.period,
+            CASE WHEN g.is_all THEN '*' ELSE COALESCE(rp.race_grade, '') END,
+            CASE WHEN p.is_all THEN '*' ELSE COALESCE(rp.race_place, '') END,
+            rh.username,
+            :sign * COUNT(*),
+            :sign * COALESCE(SUM(rh.score), 0),
+            :sign * SUM(CASE WHEN rh.honmeiba_rank = 1 THEN 1 ELSE 0 END),
+            :sign * SUM(CASE WHEN rh.honmeiba_rank = 2 THEN 1 ELSE 0 END),
+            :sign * SUM(CASE WHEN rh.honmeiba_rank = 3 THEN 1 ELSE 0 END),
+            :sign * SUM(CASE WHEN rh.honmeiba_rank BETWEEN 4 AND 5 THEN 1 ELSE 0 END),
+            :sign * SUM(CASE WHEN rh.honmeiba_rank = 0 THEN 1 ELSE 0 END)
+        FROM raise_horse rh
+        JOIN race_periods rp ON rp.race_id = rh.race_id
+        CROSS JOIN rollup g
+        CROSS JOIN rollup p
+        WHERE {race_filter}
+        GROUP BY 1, 2, 3, 4
+        ON CONFLICT (period, race_grade, race_place, username) DO UPDATE SET
+            total_races = total_races + excluded.total_races,
+            total_score = total_score + excluded.total_score,
+            first = first + excluded.first,
+            second = second + excluded.second,
+            third = third + excluded.third,
+            bbs = bbs + excluded.bbs,
+            out_of_place = out_of_place + excluded.out_of_place
+    """, params)
+    if sign < 0:
+        conn.execute("DELETE FROM leaderboard WHERE total_races <= 0")
+
+def rebuild_leaderboard(conn):
+    # 復元後や集計ルールを変えた時に、集計表を全件作り直す
+    conn.execute("DELETE FROM leaderboard")
+    apply_leaderboard_delta(conn, None, 1)
+
+def rebuild_user_totals(conn, race_ids=None):
+    """
+    users の通算成績を raise_horse から数え直す。
+    race_ids を渡した時は、そのレースに投票したユーザーだけが対象です。
+    """
+    user_filter, params = "", []
+    if race_ids is not None:
+        race_filter, params = race_filter_sql('race_id', race_ids)
+        user_filter = f"WHERE username IN (SELECT username FROM raise_horse WHERE {race_filter})"
+    conn.execute(f"""
+        UPDATE users
+        SET (score, first, second, third, bbs, out_of_place, win_rate, placing_bets_rate) = (
+            SELECT
+                COALESCE(SUM(rh.score), 0),
+                COALESCE(SUM(CASE WHEN rh.honmeiba_rank = 1 THEN 1 ELSE 0 END), 0),
+                COALESCE(SUM(CASE WHEN rh.honmeiba_rank = 2 THEN 1 ELSE 0 END), 0),
+                COALESCE(SUM(CASE WHEN rh.honmeiba_rank = 3 THEN 1 ELSE 0 END), 0),
+                COALESCE(SUM(CASE WHEN rh.honmeiba_rank BETWEEN 4 AND 5 THEN 1 ELSE 0 END), 0),
+                COALESCE(SUM(CASE WHEN rh.honmeiba_rank = 0 AND rr.race_id IS NOT NULL THEN 1 ELSE 0 END), 0),
+                COALESCE(SUM(CASE WHEN rh.honmeiba_rank = 1 THEN 1.0 ELSE 0 END) / NULLIF(COUNT(*), 0), 0),
+                COALESCE(SUM(CASE WHEN rh.honmeiba_rank BETWEEN 1 AND 3 THEN 1.0 ELSE 0 END) / NULLIF(COUNT(*), 0), 0)
+            FROM raise_horse rh
+            LEFT JOIN race_result rr ON rr.race_id = rh.race_id
+            WHERE rh.username = users.username
+        )
+        {user_filter}
+    """, params)
+
+def rescore(conn, race_ids=None):
+    """
+    結果が入っているレースの本命馬に着順・オッズ・得点を付け直し、
+    leaderboard と users の成績もあわせて更新します。race_ids が None なら全レース。
+    値が変わった予想だけを executemany でまとめて書き込み、その件数を返します。
+    コミットは呼び出し側で行います。
+    """
+    cursor = conn.cursor()
+    race_filter, params = race_filter_sql('race_id', race_ids)
+    columns = ['race_id'] + PLACE_COLUMNS + list(ODDS_COLUMNS.values())
+    cursor.execute(f"SELECT {', '.join(columns)} FROM race_result WHERE {race_filter}", params)
+    tables = {row[0]: finishing_table(dict(zip(columns, row))) for row in cursor.fetchall()}
+    if not tables:
+        return 0
+    scored_ids = sorted(tables)
+
+    race_filter, params = race_filter_sql('race_id', scored_ids)
+    cursor.execute(f"""
+        SELECT race_id, username, honmeiba, honmeiba_rank, honmeiba_odds, score
+        FROM raise_horse WHERE {race_filter}
+    """, params)
+    updates = []
+    for race_id, username, honmeiba, old_rank, old_odds, old_score in cursor.fetchall():
+        rank, odds, score = tables[race_id].get(honmeiba, (0, None, 0))
+        if (rank, odds, score) != (old_rank, old_odds, old_score):
+            updates.append((rank, odds, score, race_id, username))
+
+    # 全レースの時は集計表を作り直し、一部の時は対象レースの分だけ引いて足し直す
+    if race_ids is not None:
+        apply_leaderboard_delta(conn, scored_ids, -1)
+    cursor.executemany("""
+        UPDATE raise_horse
+        SET honmeiba_rank = ?, honmeiba_odds = ?, score = ?
+        WHERE race_id = ? AND username = ?
+    """, updates)
+    if race_ids is not None:
+        apply_leaderboard_delta(conn, scored_ids, 1)
+    else:
+        rebuild_leaderboard(conn)
+    rebuild_user_totals(conn, None if race_ids is None else scored_ids)
+    return len(updates)
+
+def main():
+    parser = argparse.ArgumentParser(description="レース結果から本命馬の得点と成績集計を付け直します")
+    parser.add_argument('race_ids', nargs='*', type=int, help="対象のレースID（省略時は全レース）")
+    parser.add_argument('--db', default='miyakeiba_app.db', help="SQLiteデータベースのパス")
+    parser.add_argument('--rules', action='store_true', help="集計期間のルールを一覧表示")
+    parser.add_argument('--include', nargs=2, metavar=('RACE_ID', 'PERIOD'), help="レースを期間（YYYY-MM / *）にも加算")
+    parser.add_argument('--exclude', nargs='+', metavar='RACE_ID [PERIOD]', help="レースを期間から外す（省略時は all）")
+    parser.add_argument('--delete-rule', type=int, metavar='RULE_ID', help="ルールを削除")
+    parser.add_argument('--note', help="追加するルールのメモ")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    if args.rules:
+        for row in conn.execute("SELECT id, race_id, period, action, note FROM scoring_period_rules ORDER BY race_id, id"):
+            print(*[value if value is not None else '' for value in row], sep='\t')
+        conn.close()
+        return
+
+    started = time.time()
+    try:
+        if args.include:
+            add_period_rule(conn, int(args.include[0]), args.include[1], 'include', args.note)
+            print(f"✅ レース {args.include[0]} を {args.include[1]} に加算するルールを追加しました")
+        elif args.exclude:
+            period = args.exclude[1] if len(args.exclude) > 1 else 'all'
+            add_period_rule(conn, int(args.exclude[0]), period, 'exclude', args.note)
+            print(f"✅ レース {args.exclude[0]} を {period} から外すルールを追加しました")
+        elif args.delete_rule:
+            if not delete_period_rule(conn, args.delete_rule):
+                print(f"⚠️ ルール {args.delete_rule} は見つかりません")
+        updated = None
+        if not (args.include or args.exclude or args.delete_rule):
+            updated = rescore(conn, args.race_ids or None)
+        # 起動中のアプリに、変更をスプレッドシートへ送ってもらう
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'backup_jobs'").fetchone():
+            conn.execute("INSERT INTO backup_jobs (requested_at, force) VALUES (?, 1)", (time.time(),))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    if updated is not None:
+        print(f"✅ {updated} 件の予想を採点し直しました（{time.time() - started:.2f} 秒）")
+
+if __name__ == '__main__':
+    main()
@@ -8,14 +8,121 @@ const sortStates = {
     monthly_score: { currentSortColumn: 2, sortDirection: 'desc' }
 };
 
+// 列番号 → /api/leaderboard の sort 名（0 は順位なので並べ替えない）
+const SORT_KEYS = [null, 'username', 'total_score', 'first', 'second', 'third', 'bbs', 'out_of_place', 'win_rate', 'placing_bets_rate'];
+const PAGE_SIZE = 50;
+
+// 表ごとの読み込み番号。並べ替え直した後に古い応答が届いても捨てる
+const requestIds = {};
+
+function formatRate(rate) {
+    return `${((rate || 0) * 100).toFixed(2)}%`;
+}
+
+function buildRow(user) {
+    const row = document.createElement('tr');
+    const cells = [
+        user.rank,
+        user.username,
+        user.total_score || 0,
+        user.first,
+        user.second,
+        user.third,
+        user.bbs,
+        user.out_of_place,
+        formatRate(user.win_rate),
+        formatRate(user.placing_bets_rate)
+    ];
+    cells.forEach((value, index) => {
+        const cell = document.createElement('td');
+        if (index >= 8) {
+            cell.className = 'rate';
+        }
+        cell.textContent = value;
+        row.appendChild(cell);
+    });
+    return row;
+}
+
+function loadLeaderboardPage(tbody) {
+    const offset = Number(tbody.dataset.offset || 0);
+    const total = tbody.dataset.total === '' ? Infinity : Number(tbody.dataset.total);
+    if (tbody.dataset.loading === 'true' || offset >= total) return;
+
+    const { currentSortColumn, sortDirection } = sortStates[tbody.id];
+    const params = new URLSearchParams({
+        sort: SORT_KEYS[currentSortColumn],
+        order: sortDirection,
+        offset: offset,
+        limit: PAGE_SIZE
+    });
+    if (tbody.dataset.grade) params.set('grade', tbody.dataset.grade);
+    if (tbody.dataset.place) params.set('place', tbody.dataset.place);
+
+    const requestId = (requestIds[tbody.id] || 0) + 1;
+    requestIds[tbody.id] = requestId;
+    tbody.dataset.loading = 'true';
+
+    fetch(`${tbody.dataset.api}?${params}`)
+        .then(response => response.json())
+        .then(data => {
+            if (requestIds[tbody.id] !== requestId) return;
+            data.rows.forEach(user => tbody.appendChild(buildRow(user)));
+            tbody.dataset.offset = offset + data.rows.length;
+            tbody.dataset.total = data.total;
+        })
+        .finally(() => {
+            if (requestIds[tbody.id] !== requestId) return;
+            tbody.dataset.loading = 'false';
+            watchMore(tbody.id);
+        });
+}
+
+// 表の下端が画面に入ったら続きを読み込む
+const moreObserver = 'IntersectionObserver' in window
+    ? new IntersectionObserver(entries => {
+        entries.forEach(entry => {
+            if (!entry.isIntersecting) return;
+            const tbody = document.getElementById(entry.target.dataset.target);
+            if (tbody) loadLeaderboardPage(tbody);
+        });
+    })
+    : null;
+
+function watchMore(tableId) {
+    const marker = document.querySelector(`.score-table-more[data-target="${tableId}"]`);
+    if (!marker || !moreObserver) return;
+    // 読み込み後もまだ画面内にある時のため、監視し直して判定させる
+    moreObserver.unobserve(marker);
+    moreObserver.observe(marker);
+}
+
+document.addEventListener('DOMContentLoaded', () => {
+    document.querySelectorAll('.score-table-more').forEach(marker => watchMore(marker.dataset.target));
+});
+
 function handleSort(tableId, columnIndex) {
     const tbody = document.getElementById(tableId);
     if (!tbody) return;
 
     const { currentSortColumn, sortDirection } = sortStates[tableId];
+    const newSortDirection = (currentSortColumn === columnIndex && sortDirection === 'asc') ? 'desc' : 'asc';
+
+    // ソート状態更新
+    sortStates[tableId] = { currentSortColumn: columnIndex, sortDirection: newSortDirection };
+    updateSortIndicator(tbody, columnIndex, newSortDirection);
+
+    // APIがある表は、サーバーで並べ替えた先頭ページから読み直す
+    if (tbody.dataset.api) {
+        tbody.innerHTML = '';
+        tbody.dataset.offset = 0;
+        tbody.dataset.total = '';
+        tbody.dataset.loading = 'false';
+        loadLeaderboardPage(tbody);
+        return;
+    }
 
     const rows = Array.from(tbody.querySelectorAll('tr'));
-    const newSortDirection = (currentSortColumn === columnIndex && sortDirection === 'asc') ? 'desc' : 'asc';
 
     const sortedRows = rows.sort((a, b) => {
         const aText = a.children[columnIndex]?.textContent.trim() || '';
@@ -45,11 +152,9 @@ function handleSort(tableId, columnIndex) {
 
     tbody.innerHTML = '';
     sortedRows.forEach(row => tbody.appendChild(row));
+}
 
-    // ソート状態更新
-    sortStates[tableId] = { currentSortColumn: columnIndex, sortDirection: newSortDirection };
-
-    // ソートアイコン更新
+function updateSortIndicator(tbody, columnIndex, direction) {
     // まずそのテーブル内の全てのアイコンをクリア
     const table = tbody.closest('table');
     table.querySelectorAll('.sort-indicator').forEach(el => el.textContent = '');
@@ -57,6 +162,6 @@ function handleSort(tableId, columnIndex) {
     // ソートしている列のアイコンだけ更新
     const header = table.querySelector(`thead tr th:nth-child(${columnIndex + 1}) .sort-indicator`);
     if (header) {
-        header.textContent = newSortDirection === 'asc' ? '▲' : '▼';
+        header.textContent = direction === 'asc' ? '▲' : '▼';
     }
 }
\ No newline at end of file